@@ -0,0 +1,66 @@
+#!/usr/bin/env python
+
+"""
+Benchmark the row-wise (rangeCalculator) and vectorized (elevRangeCalculator)
+elevation range filters of vegmapper.gedi.process_data on synthetic shot tables.
+"""
+
+import argparse
+import time
+
+import numpy as np
+import pandas as pd
+
+from vegmapper.gedi.process_data import rangeCalculator, elevRangeCalculator
+
+ELEV_COLS = ['elev1', 'elev2', 'elev3', 'elev4', 'elev5', 'elev6']
+
+
+def synthetic_shots(n, seed=0):
+    rng = np.random.default_rng(seed)
+    elevs = rng.normal(100, 3, (n, 6)).astype(np.float32)
+    # outliers so that some elevations fall outside the 2-sigma window
+    outliers = rng.random((n, 6)) < 0.05
+    elevs[outliers] += rng.choice([-60, 60], outliers.sum())
+    # shots with all elevations abnormal get the sentinel value 99
+    elevs[rng.random(n) < 0.01] += 200
+    df = pd.DataFrame(elevs, columns=ELEV_COLS)
+    df['beam'] = 'BEAM0101'
+    df['date'] = pd.Timestamp('2020-01-01')
+    elevs = pd.concat([df[c] for c in ELEV_COLS])
+    df['elev_sd'] = elevs.std()
+    df['elev_mean'] = elevs.mean()
+    return df
+
+
+def bench(n):
+    df = synthetic_shots(n)
+
+    t0 = time.perf_counter()
+    rowwise = df.apply(
+        lambda x: rangeCalculator([x['elev1'], x['elev2'], x['elev3'], x['elev4'], x['elev5'], x['elev6']],
+                                  x['elev_sd'], x['elev_mean']), axis=1)
+    t1 = time.perf_counter()
+    vectorized = elevRangeCalculator(df[ELEV_COLS].to_numpy(), df['elev_sd'].to_numpy(), df['elev_mean'].to_numpy())
+    t2 = time.perf_counter()
+
+    np.testing.assert_array_equal(rowwise.to_numpy(dtype=np.float64), vectorized)
+    print(f'{n:>9} shots: apply {t1 - t0:8.3f} s, vectorized {t2 - t1:8.4f} s, '
+          f'speedup {(t1 - t0) / (t2 - t1):8.1f}x, '
+          f'{(vectorized == 99).sum()} rows with sentinel 99')
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Benchmark GEDI elevation range filtering'
+    )
+    parser.add_argument('sizes', type=int, nargs='*', default=[10000, 100000, 300000],
+                        help='Numbers of shots of the synthetic tables')
+    args = parser.parse_args()
+
+    for n in args.sizes:
+        bench(n)
+
+
+if __name__ == '__main__':
+    main()
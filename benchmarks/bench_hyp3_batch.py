@@ -0,0 +1,125 @@
+#!/usr/bin/env python
+
+"""
+Benchmark the per-job (row by row) and columnar builds of batch_to_df and
+batch_to_dict of vegmapper.s1.hyp3 on synthetic batches of RTC jobs.
+Search results are synthetic as well, so no requests are sent to ASF.
+"""
+
+import argparse
+import time
+
+import geopandas as gpd
+import pandas as pd
+from hyp3_sdk import Batch, Job
+from shapely.geometry import box
+
+from vegmapper.s1.hyp3 import batch_to_df, batch_to_dict
+
+
+def synthetic_batch(n, n_frames=50):
+    jobs = []
+    records = []
+    t0 = pd.Timestamp('2020-01-01T10:00:00Z')
+    for i in range(n):
+        granule = f'S1A_IW_GRDH_1SDV_{i:08d}'
+        jobs.append(Job(
+            job_type='RTC_GAMMA',
+            job_id=f'job-{i:08d}',
+            request_time='2020-01-01T00:00:00Z',
+            status_code='SUCCEEDED',
+            user_id='user',
+            job_parameters={'granules': [granule]},
+            files=[{'filename': f'{granule}_RTC.zip', 'url': f'https://example.com/{granule}_RTC.zip', 'size': 1}],
+        ))
+        records.append({
+            'sceneName': granule,
+            'pathNumber': 1 + i % n_frames // 10,
+            'frameNumber': 100 + i % n_frames,
+            'startTime': t0 + pd.Timedelta(days=i // n_frames * 12),
+            'stopTime': t0 + pd.Timedelta(days=i // n_frames * 12, seconds=25),
+            'geometry': box(0, 0, 1, 1),
+        })
+    return Batch(jobs), gpd.GeoDataFrame(records, crs='EPSG:4326')
+
+
+# Previous implementations (one-row DataFrame and .loc lookups per job), kept for comparison
+def batch_to_dict_rowwise(batch, gdf_results):
+    granule_list = [job.to_dict()['job_parameters']['granules'][0] for job in batch]
+    gdf_results = gdf_results.set_index('sceneName')
+
+    batch_dict = {}
+    for granule, job in zip(granule_list, batch):
+        p = gdf_results.loc[granule, 'pathNumber']
+        f = gdf_results.loc[granule, 'frameNumber']
+        if (p, f) not in batch_dict:
+            batch_dict[(p, f)] = {
+                'batch': Batch([job]),
+                'granules': [granule]
+            }
+        else:
+            batch_dict[(p, f)]['batch'] += Batch([job])
+            batch_dict[(p, f)]['granules'].append(granule)
+
+    return batch_dict
+
+
+def batch_to_df_rowwise(batch, gdf_results):
+    granule_list = [job.to_dict()['job_parameters']['granules'][0] for job in batch]
+    gdf_results = gdf_results.set_index('sceneName')
+
+    df_products = pd.DataFrame()
+    for granule, job in zip(granule_list, batch):
+        df = pd.DataFrame(
+            {
+                'filename': [job.to_dict()['files'][0]['filename']],
+                'job_id': [job.to_dict()['job_id']],
+                'sceneName': [granule],
+                'pathNumber': [gdf_results.loc[granule, 'pathNumber']],
+                'frameNumber': [gdf_results.loc[granule, 'frameNumber']],
+                'startTime': [gdf_results.loc[granule, 'startTime']],
+                'stopTime': [gdf_results.loc[granule, 'stopTime']],
+            }
+        )
+        df_products = pd.concat([df_products, df])
+
+    return df_products.sort_values(by=['pathNumber', 'frameNumber', 'startTime']).reset_index(drop=True)
+
+
+def bench(n):
+    batch, gdf_results = synthetic_batch(n)
+
+    t0 = time.perf_counter()
+    df_rowwise = batch_to_df_rowwise(batch, gdf_results)
+    t1 = time.perf_counter()
+    df_columnar = batch_to_df(batch, gdf_results)
+    t2 = time.perf_counter()
+    pd.testing.assert_frame_equal(df_rowwise, df_columnar, check_dtype=False)
+    print(f'{n:>7} jobs: batch_to_df   row-wise {t1 - t0:8.3f} s, columnar {t2 - t1:8.4f} s, '
+          f'speedup {(t1 - t0) / (t2 - t1):8.1f}x')
+
+    t0 = time.perf_counter()
+    dict_rowwise = batch_to_dict_rowwise(batch, gdf_results)
+    t1 = time.perf_counter()
+    dict_columnar = batch_to_dict(batch, gdf_results)
+    t2 = time.perf_counter()
+    assert dict_rowwise.keys() == dict_columnar.keys()
+    for key, d in dict_rowwise.items():
+        assert d['granules'] == dict_columnar[key]['granules']
+        assert [job.job_id for job in d['batch']] == [job.job_id for job in dict_columnar[key]['batch']]
+    print(f'{n:>7} jobs: batch_to_dict row-wise {t1 - t0:8.3f} s, columnar {t2 - t1:8.4f} s, '
+          f'speedup {(t1 - t0) / (t2 - t1):8.1f}x')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark batch_to_df and batch_to_dict')
+    parser.add_argument('--sizes', type=int, nargs='+', default=[1000, 10000],
+                        help='numbers of synthetic jobs')
+    args = parser.parse_args()
+
+    for n in args.sizes:
+        bench(n)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,115 @@
+#!/usr/bin/env python
+
+"""
+Benchmark the pairwise (all frames against all frames) and STRtree-based
+skim_granules of vegmapper.s1.search on synthetic Sentinel-1 frame sets.
+"""
+
+import argparse
+import tempfile
+import time
+from functools import reduce
+
+import geopandas as gpd
+import numpy as np
+import pandas as pd
+from shapely.geometry import Polygon, box
+
+from vegmapper.s1.search import skim_granules
+
+
+def synthetic_frames(n_paths, n_frames, seed=0):
+    """
+    Frames of n_paths tracks with n_frames frames each, overlapping along and across tracks,
+    plus near duplicates (> 95% overlap) of 10% of the frames, as found in multi-year searches.
+    """
+    rng = np.random.default_rng(seed)
+    records = []
+    for p in range(n_paths):
+        for f in range(n_frames):
+            x0 = p * 1.8 + f * 0.3
+            y0 = f * 1.6
+            geometry = Polygon([(x0, y0), (x0 + 2.5, y0 + 0.4), (x0 + 2.8, y0 + 2.1), (x0 + 0.3, y0 + 1.7)])
+            records.append([p, 100 + f, 2, f'S1_{p}_{f}_A,S1_{p}_{f}_B', geometry])
+            if rng.random() < 0.1:
+                dx, dy = rng.uniform(-0.02, 0.02, 2)
+                shifted = Polygon([(x + dx, y + dy) for x, y in geometry.exterior.coords])
+                records.append([p, 1000 + f, 1, f'S1_{p}_{f}_C', shifted])
+    gdf_frames = gpd.GeoDataFrame(records, columns=['pathNumber', 'frameNumber', 'num_granules', 'granules', 'geometry'],
+                                  crs='EPSG:4326')
+    gdf_granules = pd.DataFrame({'sceneName': ','.join(gdf_frames.granules).split(',')})
+    return gdf_granules, gdf_frames
+
+
+# Previous implementation (every frame compared with every other frame), kept for comparison
+def skim_granules_pairwise(aoifile, gdf_granules, gdf_frames):
+    gdf_aoi = gpd.read_file(aoifile).dissolve()
+
+    neighbors = []
+    for i, row in gdf_frames.iterrows():
+        overlap = gdf_frames.geometry.apply(lambda x: x.intersection(row['geometry']).area/row['geometry'].area)
+        indices = overlap[overlap > 0.95].index.to_list()
+        if len(indices) > 1 and indices not in neighbors:
+            neighbors.append(indices)
+
+    if neighbors:
+        # Merged frame numbers are strings (e.g. '102-1002')
+        gdf_frames['frameNumber'] = gdf_frames['frameNumber'].astype(object)
+    for indices in neighbors:
+        frameNumber = reduce(lambda x, y: f'{x}-{y}', gdf_frames.frameNumber[indices])
+        num_granules = reduce(lambda x, y: x+y, gdf_frames.num_granules[indices])
+        granules = reduce(lambda x, y: f'{x},{y}', gdf_frames.granules[indices])
+        geometry = reduce(lambda x, y: x.union(y), gdf_frames.geometry[indices])
+        gdf_frames.loc[indices, 'frameNumber'] = frameNumber
+        gdf_frames.loc[indices, 'num_granules'] = num_granules
+        gdf_frames.loc[indices, 'granules'] = granules
+        gdf_frames.loc[indices, 'geometry'] = geometry
+    gdf_frames = gdf_frames.drop_duplicates().reset_index(drop=True)
+
+    gdf_frames['overlap_with_aoi'] = 0.0
+    for i, row in gdf_frames.iterrows():
+        idx = [i] + gdf_frames.index.drop(i).to_list()
+        geom = reduce(lambda x, y: x.difference(y), gdf_frames.geometry[idx])
+        area = gdf_aoi.geometry[0].intersection(geom).area
+        gdf_frames.loc[i, 'overlap_with_aoi'] = area
+
+    granules_to_drop = ','.join(gdf_frames.loc[gdf_frames.overlap_with_aoi == 0, 'granules']).split(',')
+    gdf_granules = gdf_granules[~gdf_granules['sceneName'].isin(granules_to_drop)].reset_index(drop=True)
+    gdf_frames = gdf_frames[gdf_frames.overlap_with_aoi > 0].reset_index(drop=True)
+    gdf_frames = gdf_frames[['pathNumber', 'frameNumber', 'num_granules', 'granules', 'overlap_with_aoi', 'geometry']]
+
+    return gdf_granules, gdf_frames
+
+
+def bench(n_paths, n_frames, aoifile):
+    gdf_granules, gdf_frames = synthetic_frames(n_paths, n_frames)
+
+    t0 = time.perf_counter()
+    granules_pairwise, frames_pairwise = skim_granules_pairwise(aoifile, gdf_granules, gdf_frames.copy())
+    t1 = time.perf_counter()
+    granules_strtree, frames_strtree = skim_granules(aoifile, gdf_granules, gdf_frames.copy())
+    t2 = time.perf_counter()
+
+    pd.testing.assert_frame_equal(granules_pairwise, granules_strtree)
+    pd.testing.assert_frame_equal(frames_pairwise.drop(columns='geometry'), frames_strtree.drop(columns='geometry'),
+                                  check_exact=False, rtol=1e-6)
+    print(f'{len(gdf_frames):>6} frames: pairwise {t1 - t0:8.3f} s, STRtree {t2 - t1:8.4f} s, '
+          f'speedup {(t1 - t0) / (t2 - t1):8.1f}x, {len(frames_strtree)} frames kept')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark skim_granules')
+    parser.add_argument('--paths', type=int, nargs='+', default=[5, 10, 20],
+                        help='numbers of tracks (with 20 frames each)')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for n_paths in args.paths:
+            # AOI covering the middle of the frame set
+            aoifile = f'{tmp_dir}/aoi_{n_paths}.geojson'
+            gpd.GeoDataFrame(geometry=[box(n_paths * 0.5, 8, n_paths * 1.5, 24)], crs='EPSG:4326').to_file(aoifile)
+            bench(n_paths, 20, aoifile)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,37 @@
+import geopandas as gpd
+import numpy as np
+import rasterio
+from shapely.geometry import box
+
+from vegmapper.gedi.grid_shots import ShotGridder
+
+
+def test_empty_active_tile_gets_layers(tmp_path):
+    # 3 x 1 tiles of 300 m in UTM 18N: h0 and h1 active, h2 inactive
+    x0, y0, size = 500000, 100000, 300
+    gdf_tiles = gpd.GeoDataFrame(
+        {'h': [0, 1, 2], 'v': [0, 0, 0], 'mask': [1, 1, 0]},
+        geometry=[box(x0 + i * size, y0 - size, x0 + (i + 1) * size, y0) for i in range(3)],
+        crs='EPSG:32618')
+    gridder = ShotGridder(gdf_tiles, res=30)
+
+    # Shots in the first cell of h0 only
+    lon, lat = gridder.transformer.transform(np.full(3, x0 + 15.0), np.full(3, y0 - 15.0), direction='INVERSE')
+    gridder.add(lon, lat, {'rh95': [10.0, 20.0, 30.0]})
+    out_files = gridder.write(str(tmp_path))
+
+    assert sorted(out_files) == sorted(str(tmp_path / f'gedi_h{h}v0_{name}.tif')
+                                       for h in [0, 1] for name in ['count', 'rh95_mean'])
+
+    with rasterio.open(tmp_path / 'gedi_h0v0_rh95_mean.tif') as dset:
+        mean = dset.read(1)
+        assert dset.transform.c == x0 and dset.transform.f == y0
+    assert mean[0, 0] == 20 and np.isnan(mean).sum() == mean.size - 1
+    with rasterio.open(tmp_path / 'gedi_h0v0_count.tif') as dset:
+        assert dset.read(1)[0, 0] == 3
+
+    with rasterio.open(tmp_path / 'gedi_h1v0_rh95_mean.tif') as dset:
+        assert dset.shape == (10, 10) and dset.transform.c == x0 + size
+        assert np.isnan(dset.read(1)).all()
+    with rasterio.open(tmp_path / 'gedi_h1v0_count.tif') as dset:
+        assert (dset.read(1) == 0).all()
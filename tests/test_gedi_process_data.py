@@ -0,0 +1,61 @@
+import json
+import os
+import shutil
+
+import h5py
+import numpy as np
+import pandas as pd
+import pytest
+from shapely.geometry import box
+
+from vegmapper.gedi import process_data
+
+
+def write_granule(h5file, lon, lat, n=20):
+    # minimal GEDI L2A granule with one beam of n shots around (lon, lat)
+    rng = np.random.default_rng(0)
+    with h5py.File(h5file, 'w') as f:
+        beam = f.create_group('BEAM0101')
+        for _, path in process_data.BEAM_FIELDS:
+            beam.create_dataset(path, data=np.full(n, 100.0) + rng.uniform(0, 1, n))
+        beam['lon_lowestmode'][...] = lon + rng.uniform(-0.01, 0.01, n)
+        beam['lat_lowestmode'][...] = lat + rng.uniform(-0.01, 0.01, n)
+        beam['sensitivity'][...] = 0.95
+        beam['quality_flag'][...] = 1
+        beam['shot_number'][...] = np.arange(n)
+        beam['delta_time'][...] = 1e8
+        beam.create_dataset('rh', data=np.tile(np.linspace(0, 20, 101), (n, 1)))
+
+
+@pytest.mark.parametrize('output_format', ['csv', 'parquet'])
+def test_granule_without_shots_in_aoi_is_done(tmp_path, monkeypatch, output_format):
+    src_dir = tmp_path / 'src'
+    src_dir.mkdir()
+    granules = {'GEDI02_A_INSIDE': (10.0, 5.0), 'GEDI02_A_OUTSIDE': (30.0, 5.0)}
+    for granule, (lon, lat) in granules.items():
+        write_granule(src_dir / f'{granule}.h5', lon, lat)
+    urls_file = tmp_path / 'urls.txt'
+    urls_file.write_text(''.join(f'https://example.com/{g}.h5\n' for g in granules))
+
+    def fake_download(session, url, save_dir):
+        name = url.split('/')[-1]
+        return shutil.copy(src_dir / name, os.path.join(save_dir, name))
+
+    monkeypatch.setattr(process_data, 'download_h5', fake_download)
+    aoi = box(9, 4, 11, 6)
+
+    process_data.download_and_process_h5_files(str(urls_file), str(tmp_path), 'run', 'token', n_processes=1,
+                                               output_format=output_format, aoi=aoi)
+
+    ledger_file = tmp_path / 'run' / 'run_ledger.jsonl'
+    records = [json.loads(line) for line in ledger_file.read_text().splitlines()]
+    assert {r['granule']: r['status'] for r in records} == {g: 'done' for g in granules}
+    assert process_data.readLedger(str(ledger_file)) == set(granules)
+
+    if output_format == 'csv':
+        assert len(pd.read_csv(tmp_path / 'run' / 'GEDI02_A_OUTSIDE.csv')) == 0
+        assert len(pd.read_csv(tmp_path / 'run' / 'GEDI02_A_INSIDE.csv')) > 0
+    else:
+        shots = process_data.read_gedi_shots(str(tmp_path / 'run' / process_data.PARQUET_DIR))
+        assert len(shots) > 0
+        assert ((shots['long'] > 9) & (shots['long'] < 11)).all()
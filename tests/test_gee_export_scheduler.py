@@ -0,0 +1,125 @@
+import importlib
+import itertools
+import sys
+import types
+
+import pytest
+
+try:
+    import ee  # noqa: F401
+except ImportError:
+    # The scheduler only needs ee.data.getTaskList, which is stubbed below
+    sys.modules['ee'] = types.ModuleType('ee')
+
+scheduler_module = importlib.import_module('vegmapper.gee.gee_export_scheduler')
+ExportScheduler = scheduler_module.ExportScheduler
+
+
+class FakeGEE(object):
+    """
+    Stub of the GEE task API. Each started task goes through the states in
+    outcomes[description] (one state per attempt, the last one repeated),
+    reported by getTaskList on the next poll.
+    """
+    def __init__(self, outcomes):
+        self.outcomes = outcomes
+        self.states = {}
+        self.started = []
+        self.ids = itertools.count()
+        self.data = types.SimpleNamespace(getTaskList=self.get_task_list)
+
+    def get_task_list(self):
+        return [{'id': task_id, 'state': state, 'error_message': 'error'} for task_id, state in self.states.items()]
+
+    def task_factory(self, description):
+        gee = self
+
+        class Task(object):
+            def __init__(self):
+                self.id = None
+                self.config = {'description': description,
+                               'fileExportOptions': {'gcsDestination': {'bucket': 'bucket', 'filenamePrefix': description}}}
+
+            def start(self):
+                self.id = f'{description}-{next(gee.ids)}'
+                attempt = sum(d == description for d in gee.started)
+                outcomes = gee.outcomes[description]
+                gee.states[self.id] = outcomes[min(attempt, len(outcomes) - 1)]
+                gee.started.append(description)
+
+        return Task
+
+
+@pytest.fixture
+def fake_gee(monkeypatch):
+    def make(outcomes):
+        gee = FakeGEE(outcomes)
+        monkeypatch.setattr(scheduler_module, 'ee', gee)
+        return gee
+    return make
+
+
+def run_scheduler(gee, export_dst_json, descriptions, max_retries=2, on_complete=None):
+    scheduler = ExportScheduler(export_dst_json=export_dst_json, max_running=2, poll_interval=0,
+                                max_retries=max_retries, on_complete=on_complete)
+    for description in descriptions:
+        scheduler.add(description, gee.task_factory(description))
+    scheduler.run()
+    return scheduler
+
+
+def test_failed_task_retried_up_to_limit(tmp_path, fake_gee):
+    gee = fake_gee({'h0v0': ['FAILED'], 'h1v0': ['FAILED', 'COMPLETED']})
+    scheduler = run_scheduler(gee, tmp_path / 'export_dst.json', ['h0v0', 'h1v0'], max_retries=2)
+
+    assert gee.started.count('h0v0') == 3
+    assert gee.started.count('h1v0') == 2
+    assert scheduler.failed == ['h0v0']
+    assert scheduler.completed == ['h1v0']
+
+    # Retries exhausted in the first run are not resubmitted
+    gee.started.clear()
+    scheduler = run_scheduler(gee, tmp_path / 'export_dst.json', ['h0v0', 'h1v0'], max_retries=2)
+    assert gee.started == []
+    assert scheduler.failed == ['h0v0']
+
+
+def test_restart_resumes_from_export_dst_json(tmp_path, fake_gee):
+    export_dst_json = tmp_path / 'export_dst.json'
+    gee = fake_gee({'h0v0': ['COMPLETED'], 'h1v0': ['RUNNING']})
+
+    # First run interrupted while h1v0 is still running on GEE
+    scheduler = ExportScheduler(export_dst_json=export_dst_json, max_running=2, poll_interval=0)
+    for description in ['h0v0', 'h1v0']:
+        scheduler.add(description, gee.task_factory(description))
+    for description in list(scheduler.pending):
+        scheduler.start(description)
+    scheduler.pending.clear()
+    scheduler.poll()
+    scheduler.save()
+    assert scheduler.completed == ['h0v0']
+
+    # h1v0 completes on GEE, and the restarted scheduler only polls it
+    h1v0_id = [task_id for task_id in gee.states if task_id.startswith('h1v0')][0]
+    gee.states[h1v0_id] = 'COMPLETED'
+    gee.started.clear()
+    scheduler = run_scheduler(gee, export_dst_json, ['h0v0', 'h1v0'])
+    assert gee.started == []
+    assert sorted(scheduler.completed) == ['h0v0', 'h1v0']
+
+
+def test_on_complete_downloads_once(tmp_path, fake_gee):
+    export_dst_json = tmp_path / 'export_dst.json'
+    gee = fake_gee({'h0v0': ['COMPLETED'], 'h1v0': ['FAILED', 'COMPLETED']})
+    downloads = []
+
+    def on_complete(description, export_opts):
+        assert export_opts == {'gcsDestination': {'bucket': 'bucket', 'filenamePrefix': description}}
+        downloads.append(description)
+
+    run_scheduler(gee, export_dst_json, ['h0v0', 'h1v0'], on_complete=on_complete)
+    assert sorted(downloads) == ['h0v0', 'h1v0']
+
+    # Downloaded tiles are not downloaded again when the scheduler is run again
+    run_scheduler(gee, export_dst_json, ['h0v0', 'h1v0'], on_complete=on_complete)
+    assert sorted(downloads) == ['h0v0', 'h1v0']
@@ -0,0 +1,78 @@
+import numpy as np
+import rasterio
+from rasterio.transform import from_origin
+
+from vegmapper.core.landsat_ndvi import SR_OFFSET, SR_SCALE, clear_mask, composite_tile
+
+
+def test_clear_mask_collection2_qa_pixel():
+    # Landsat 8-9 Collection 2 QA_PIXEL values
+    qa = {
+        1: False,       # fill
+        21824: True,    # clear land
+        21952: True,    # clear water
+        30048: True,    # snow (bit 5)
+        21762: False,   # dilated cloud (bit 1)
+        22280: False,   # cloud (bit 3), high confidence
+        23888: False,   # cloud shadow (bit 4)
+    }
+    values = np.array(list(qa.keys()), dtype=np.uint16)
+    assert clear_mask(values).tolist() == list(qa.values())
+
+
+def write_scene(scene, red, nir, qa, transform, crs):
+    profile = {'driver': 'GTiff', 'width': red.shape[1], 'height': red.shape[0], 'count': 1,
+               'crs': crs, 'transform': transform}
+    for suffix, data in zip(['SR_B4', 'SR_B5', 'QA_PIXEL'], [red, nir, qa]):
+        with rasterio.open(f'{scene}_{suffix}.TIF', 'w', dtype='uint16', **profile) as dst:
+            dst.write(data.astype(np.uint16), 1)
+
+
+def test_composite_tile(tmp_path):
+    crs = 'EPSG:32618'
+    res = 30
+    height, width = 5, 7
+    xmin, ymax = 500000, 1000000
+    bounds = (xmin, ymax - height * res, xmin + width * res, ymax)
+    transform = from_origin(xmin, ymax, res, res)
+
+    # Reflectances of about 0.05 (red) and 0.3, 0.4, 0.5 (nir) for the 3 scenes
+    red_dn = round((0.05 - SR_OFFSET) / SR_SCALE)
+    nir_dn = [round((r - SR_OFFSET) / SR_SCALE) for r in [0.3, 0.4, 0.5]]
+    red_sr = red_dn * SR_SCALE + SR_OFFSET
+    ndvi = [(n * SR_SCALE + SR_OFFSET - red_sr) / (n * SR_SCALE + SR_OFFSET + red_sr) for n in nir_dn]
+
+    scenes = []
+    for k in range(3):
+        red = np.full((height, width), red_dn)
+        nir = np.full((height, width), nir_dn[k])
+        qa = np.full((height, width), 21824)
+        if k == 0:
+            # cloudy pixel
+            qa[0, 0] = 22280
+        if k == 2:
+            # fill pixel
+            red[2, 3] = nir[2, 3] = 0
+            qa[2, 3] = 1
+        # fill pixel in all scenes
+        red[4, 6] = nir[4, 6] = 0
+        qa[4, 6] = 1
+        scene = str(tmp_path / f'scene{k}')
+        write_scene(scene, red, nir, qa, transform, crs)
+        scenes.append(scene)
+
+    # Blocks smaller than the tile, with partial blocks at the right and bottom edges
+    out_tif = composite_tile(scenes, crs, bounds, res, tmp_path / 'ndvi.tif', block_size=4)
+
+    with rasterio.open(out_tif) as dset:
+        assert dset.shape == (height, width)
+        assert dset.transform == transform
+        assert dset.crs == rasterio.crs.CRS.from_string(crs)
+        assert np.isnan(dset.nodata)
+        out = dset.read(1)
+
+    expected = np.full((height, width), ndvi[1])
+    expected[0, 0] = np.median(ndvi[1:])
+    expected[2, 3] = np.median(ndvi[:2])
+    expected[4, 6] = np.nan
+    np.testing.assert_allclose(out, expected, rtol=1e-5)
@@ -0,0 +1,78 @@
+from datetime import datetime
+
+import geopandas as gpd
+import pytest
+from shapely.geometry import box
+
+pytest.importorskip('osgeo')
+from hyp3_sdk import HyP3, Batch, Job  # noqa: E402
+
+from vegmapper.s1 import hyp3  # noqa: E402
+
+
+class FakeHyP3(object):
+    """
+    Stub of hyp3_sdk.HyP3 with jobs_on_hyp3 (job_parameters of previously submitted jobs)
+    on the server, recording the chunks passed to submit_prepared_jobs.
+    """
+    def __init__(self, jobs_on_hyp3=(), quota=1000):
+        self.quota = quota
+        self.batch = Batch([self.job(job_parameters) for job_parameters in jobs_on_hyp3])
+        self.submitted = []
+
+    @staticmethod
+    def job(job_parameters, name=None):
+        return Job('RTC_GAMMA', f'job-{job_parameters["granules"][0]}', datetime(2024, 1, 1), 'SUCCEEDED', 'user',
+                   name=name, job_parameters=job_parameters)
+
+    def check_quota(self):
+        return self.quota
+
+    def find_jobs(self):
+        return self.batch
+
+    def prepare_rtc_job(self, granule, name, **kwargs):
+        return HyP3.prepare_rtc_job(granule, name, **kwargs)
+
+    def submit_prepared_jobs(self, prepared_jobs):
+        self.submitted.append([job['job_parameters']['granules'][0] for job in prepared_jobs])
+        return Batch([self.job(job['job_parameters'], job['name']) for job in prepared_jobs])
+
+
+@pytest.fixture
+def granules():
+    # 5 granules of one frame
+    names = [f'S1A_IW_GRDH_1SDV_2024010{i}T000000_2024010{i}T000030_000000_000000_0000' for i in range(1, 6)]
+    return gpd.GeoDataFrame({'sceneName': names, 'pathNumber': 1, 'frameNumber': 100},
+                            geometry=[box(0, 0, 1, 1)] * len(names), crs='EPSG:4326')
+
+
+def test_submit_in_chunks(tmp_path, granules):
+    fake = FakeHyP3()
+    batch, job_name = hyp3.submit_rtc_jobs(granules, tmp_path, hyp3=fake, job_name='test',
+                                           confirm=True, chunk_size=2, resolution=30)
+
+    assert sorted(len(chunk) for chunk in fake.submitted) == [1, 2, 2]
+    assert sorted(g for chunk in fake.submitted for g in chunk) == sorted(granules.sceneName)
+    assert len(batch) == len(granules)
+    assert job_name == 'test'
+
+
+def test_skip_submitted_jobs(tmp_path, granules):
+    # Jobs on HyP3 report resolution as a float
+    submitted = granules.sceneName[:2].to_list()
+    fake = FakeHyP3(jobs_on_hyp3=[{'granules': [g], 'resolution': 30.0} for g in submitted])
+    hyp3.submit_rtc_jobs(granules, tmp_path, hyp3=fake, confirm=True, chunk_size=2, resolution=30)
+
+    submitted_now = [g for chunk in fake.submitted for g in chunk]
+    assert sorted(submitted_now) == sorted(granules.sceneName[2:])
+
+
+def test_confirm_false_submits_nothing(tmp_path, granules, monkeypatch):
+    def no_input(prompt):
+        raise AssertionError('prompted for confirmation')
+
+    monkeypatch.setattr('builtins.input', no_input)
+    fake = FakeHyP3()
+    assert hyp3.submit_rtc_jobs(granules, tmp_path, hyp3=fake, confirm=False, resolution=30) is None
+    assert fake.submitted == []
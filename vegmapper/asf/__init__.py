@@ -1,2 +1,2 @@
 from .geo_search import geo_search
-from .granule_search import granule_search
+from .granule_search import granule_search, granule_metadata
@@ -1,22 +1,145 @@
 #!/usr/bin/env python
 
+import hashlib
+import json
+import os
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
 import asf_search as asf
 import geopandas as gpd
+import numpy as np
+import pandas as pd
+from shapely.geometry import box
+
+# Date windows are aligned to this origin, so the same windows are searched
+# (and found in the cache) when the date range of a search is extended
+WINDOW_ORIGIN = pd.Timestamp('1970-01-01')
+
+# Windows ending less than this many days ago are not cached, as new
+# products can still be added to the archive for them
+CACHE_MIN_AGE_DAYS = 30
+
+
+def date_windows(start, end, window_days):
+    """
+    Aligned date windows [(window_start, window_end), ...] of window_days days covering start to end.
+    """
+    start = pd.Timestamp(start).tz_localize(None)
+    end = pd.Timestamp(end).tz_localize(None)
+    step = pd.Timedelta(days=window_days)
+    window_start = WINDOW_ORIGIN + (start - WINDOW_ORIGIN) // step * step
+    windows = []
+    while window_start <= end:
+        windows.append((window_start, window_start + step))
+        window_start += step
+    return windows
+
+
+def aoi_parts(aoi, cell_size):
+    """
+    Split an AOI geometry into polygons and, if cell_size is set, into cells of cell_size x cell_size degrees.
+    """
+    parts = list(aoi.geoms) if hasattr(aoi, 'geoms') else [aoi]
+    if cell_size is None:
+        return parts
+
+    xmin, ymin, xmax, ymax = aoi.bounds
+    cells = [box(x, y, x + cell_size, y + cell_size)
+             for x in np.arange(np.floor(xmin / cell_size) * cell_size, xmax, cell_size)
+             for y in np.arange(np.floor(ymin / cell_size) * cell_size, ymax, cell_size)]
+    split_parts = []
+    for part in parts:
+        for cell in cells:
+            if part.intersects(cell):
+                piece = part.intersection(cell)
+                split_parts.extend([g for g in getattr(piece, 'geoms', [piece]) if g.area > 0])
+    return split_parts
 
 
-def geo_search(aoifile, **search_opts):
+def search_piece(aoi_wkt, search_opts, cache_dir=None, cacheable=False):
+    """
+    Run asf_search.geo_search for a piece of a search and return (features of the results, from_cache).
+    The features are saved to cache_dir/{query hash}.json if cacheable is True.
+    """
+    cache_file = None
+    if cache_dir is not None:
+        query = json.dumps({'intersectsWith': aoi_wkt, **search_opts}, sort_keys=True, default=str)
+        cache_file = Path(cache_dir) / f'{hashlib.sha256(query.encode()).hexdigest()}.json'
+        if cache_file.exists():
+            with open(cache_file) as f:
+                return json.load(f), True
+
+    features = asf.geo_search(intersectsWith=aoi_wkt, **search_opts).geojson()['features']
+
+    if cache_file is not None and cacheable:
+        tmp_file = Path(f'{cache_file}.tmp')
+        with open(tmp_file, 'w') as f:
+            json.dump(features, f)
+        os.replace(tmp_file, cache_file)
+
+    return features, False
+
+
+def geo_search(aoifile, window_days=None, aoi_cell_size=None, max_workers=4, cache_dir=None, **search_opts):
     """
     A wrapper of asf_search.geo_search with following modifications:
         1. Take a vector-based spatial data format (e.g., shapefile, GeoJSON, etc.) as the input for AOI rather than using WKT.
         2. Simplify the geometric object (e.g., polygon) so that ASF SearchAPI won't run out of time.
         3. Return search results as a GeoDataFrame.
+        4. Split the search into date windows of window_days days (if window_days, start and end are given)
+           and AOI parts (polygons of the AOI, cut into cells of aoi_cell_size degrees if set), which are
+           searched concurrently by max_workers threads. Results are deduplicated by fileID (or by
+           sceneName and processingLevel), so products of the same scene at different levels are kept.
+        5. Cache the results of each piece in cache_dir (if set), so repeating a search or extending its
+           date range only searches the new windows. Windows ending in the last CACHE_MIN_AGE_DAYS days
+           are always searched again. With window_days=None, the whole date range is a single piece, which
+           is cached as well (if it ends before the last CACHE_MIN_AGE_DAYS days), but extending the date
+           range searches the whole range again.
     """
 
     gdf_aoi = gpd.read_file(aoifile).dissolve()
-    aoi_wkt = gdf_aoi.simplify(0.1).geometry[0].wkt
+    if gdf_aoi.crs is not None and gdf_aoi.crs.to_epsg() != 4326:
+        gdf_aoi = gdf_aoi.to_crs('EPSG:4326')
+    aoi = gdf_aoi.simplify(0.1).geometry[0]
+    aoi_wkts = [part.wkt for part in aoi_parts(aoi, aoi_cell_size)]
+
+    if cache_dir is not None:
+        Path(cache_dir).mkdir(parents=True, exist_ok=True)
+
+    # Plan the pieces of the search
+    cache_before = pd.Timestamp.now() - pd.Timedelta(days=CACHE_MIN_AGE_DAYS)
+    pieces = []
+    if window_days is not None and 'start' in search_opts and 'end' in search_opts:
+        start = pd.Timestamp(search_opts['start'])
+        end = pd.Timestamp(search_opts['end'])
+        for window_start, window_end in date_windows(start, end, window_days):
+            opts = {**search_opts,
+                    'start': window_start.strftime('%Y-%m-%dT%H:%M:%SZ'),
+                    'end': window_end.strftime('%Y-%m-%dT%H:%M:%SZ')}
+            pieces += [(aoi_wkt, opts, window_end < cache_before) for aoi_wkt in aoi_wkts]
+    else:
+        start = end = None
+        cacheable = 'end' in search_opts and pd.Timestamp(search_opts['end']).tz_localize(None) < cache_before
+        pieces = [(aoi_wkt, search_opts, cacheable) for aoi_wkt in aoi_wkts]
+
+    with ThreadPoolExecutor(max_workers) as pool:
+        results = list(pool.map(lambda piece: search_piece(piece[0], piece[1], cache_dir, piece[2]), pieces))
+    num_searched = sum(not from_cache for _, from_cache in results)
+    print(f'{num_searched} searches, {len(pieces) - num_searched} pieces from cache ({len(aoi_wkts)} AOI parts)')
+
+    features = [feature for piece_features, _ in results for feature in piece_features]
+    if len(features) == 0:
+        return gpd.GeoDataFrame()
 
-    search_results = asf.geo_search(intersectsWith=aoi_wkt, **search_opts)
+    gdf_results = gpd.GeoDataFrame.from_features(features)
+    subset = ['fileID'] if 'fileID' in gdf_results else ['sceneName', 'processingLevel']
+    gdf_results = gdf_results.drop_duplicates(subset=subset).reset_index(drop=True)
 
-    gdf_results = gpd.GeoDataFrame.from_features(search_results.geojson()['features'])
+    # Windows are aligned, so results outside of the requested dates are dropped
+    if start is not None:
+        start_time = pd.to_datetime(gdf_results['startTime'], utc=True).dt.tz_localize(None)
+        in_range = (start_time >= start.tz_localize(None)) & (start_time <= end.tz_localize(None))
+        gdf_results = gdf_results[in_range].reset_index(drop=True)
 
     return gdf_results
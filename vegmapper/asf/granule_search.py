@@ -1,9 +1,19 @@
 #!/usr/bin/env python
 
+import os
+import tempfile
+from pathlib import Path
+
 import asf_search as asf
 import geopandas as gpd
 import pandas as pd
 
+from vegmapper import pathurl
+from vegmapper.pathurl import PathURL
+
+# Columns of granule metadata kept in the cache of granule_metadata
+GRANULE_CACHE_COLUMNS = ['sceneName', 'pathNumber', 'frameNumber', 'startTime', 'stopTime']
+
 
 def granule_search(granule_list, processingLevel='GRD_HD'):
     """
@@ -22,3 +32,51 @@ def granule_search(granule_list, processingLevel='GRD_HD'):
     gdf_results['stopTime']= pd.to_datetime(gdf_results['stopTime'])
 
     return gdf_results
+
+
+def granule_metadata(granule_list, cache_file=None, processingLevel='GRD_HD', chunk_size=500):
+    """
+    Path, frame and start/stop times of granules (DataFrame with GRANULE_CACHE_COLUMNS).
+
+    Metadata are served from cache_file (a Parquet file, local or cloud URL, keyed by sceneName),
+    and only the granules not in the cache are searched with granule_search, in chunks of
+    chunk_size granules. The cache is updated with the search results.
+    """
+    granule_list = list(dict.fromkeys(granule_list))
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        if cache_file is not None:
+            cache_file = PathURL(cache_file)
+            local_cache = cache_file.path if cache_file.is_local else Path(tmp_dir) / 'granule_metadata.parquet'
+            if cache_file.exists():
+                if not cache_file.is_local:
+                    pathurl.copy(cache_file, local_cache, overwrite=True)
+                df_cache = pd.read_parquet(local_cache)
+            else:
+                df_cache = pd.DataFrame(columns=GRANULE_CACHE_COLUMNS)
+        else:
+            df_cache = pd.DataFrame(columns=GRANULE_CACHE_COLUMNS)
+
+        # Bulk search for the granules not in the cache
+        cached = set(df_cache['sceneName'])
+        misses = [granule for granule in granule_list if granule not in cached]
+        df_new = [granule_search(misses[i:i+chunk_size], processingLevel)[GRANULE_CACHE_COLUMNS]
+                  for i in range(0, len(misses), chunk_size)]
+        if misses:
+            print(f'{len(granule_list) - len(misses)} granules found in cache, {len(misses)} granules searched')
+
+        if df_new:
+            df_new = pd.DataFrame(pd.concat(df_new, ignore_index=True))
+            df_cache = df_new if len(df_cache) == 0 else pd.concat([df_cache, df_new], ignore_index=True)
+            df_cache = df_cache.drop_duplicates(subset='sceneName', keep='last').reset_index(drop=True)
+
+            if cache_file is not None:
+                # Write to a temporary file first, so the cache is never partially written
+                local_cache.parent.mkdir(parents=True, exist_ok=True)
+                tmp_cache = Path(f'{local_cache}.tmp')
+                df_cache.to_parquet(tmp_cache, index=False)
+                os.replace(tmp_cache, local_cache)
+                if not cache_file.is_local:
+                    pathurl.copy(local_cache, cache_file, overwrite=True)
+
+    return df_cache[df_cache['sceneName'].isin(granule_list)].reset_index(drop=True)
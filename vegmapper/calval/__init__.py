@@ -1,2 +1,3 @@
 from .label_utils import *
 from .sample_utils import *
+from .extract_utils import *
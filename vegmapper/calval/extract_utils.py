@@ -0,0 +1,174 @@
+import geopandas as gpd
+import numpy as np
+import pandas as pd
+import rasterio
+from rasterio.windows import Window
+
+
+def _group_size(block, min_size=512):
+    """
+    Round the group size up to a multiple of the raster block size so that
+    stripped rasters (1-row blocks) still batch many points per read.
+    """
+    return int(np.ceil(max(min_size, block) / block) * block)
+
+
+def _window_stats(data, nodata):
+    """
+    Compute mean, std and valid pixel count for a stack of windows.
+
+    Args:
+        data (np.ndarray): Array of shape (bands, points, win_size, win_size).
+        nodata (list): Nodata value for each band (None if not set).
+
+    Returns:
+        tuple: Three arrays of shape (bands, points) holding the mean, the
+        (population) standard deviation and the number of valid pixels.
+    """
+    data = data.astype(np.float64)
+    for i, nd in enumerate(nodata):
+        if nd is not None and not np.isnan(nd):
+            data[i][data[i] == nd] = np.nan
+    valid = ~np.isnan(data)
+    count = valid.sum(axis=(2, 3))
+    data = np.where(valid, data, 0)
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        mean = data.sum(axis=(2, 3)) / count
+        dev = np.where(valid, data - mean[:, :, None, None], 0)
+        std = np.sqrt((dev**2).sum(axis=(2, 3)) / count)
+
+    return mean, std, count
+
+
+def extract_window_stats(stack, points, win_size=3, bands=None,
+                         band_names=None, nodata=None, x_col='center_lon',
+                         y_col='center_lat', crs='epsg:4326'):
+
+    """
+    Extract neighborhood statistics of stack bands around sample points.
+
+    This is the Python counterpart of the R getPixel helper used in the
+    example analysis: for each point, the NxN window centered on the pixel
+    containing the point is read and the mean, standard deviation and number
+    of valid pixels are computed for each band. Windows falling in the same
+    block of the raster are batched into a single read, and the statistics
+    are computed for all points of a batch at once.
+
+    Pixels equal to nodata (or NaN) and pixels outside the raster extent are
+    excluded from the statistics, so windows on the raster edge are kept and
+    simply have a smaller count. Points with no valid pixel get NaN mean/std
+    and a count of 0.
+
+    Args:
+        stack (str): Path/URL of the raster stack (any GDAL readable dataset,
+            e.g. a VRT or /vsis3/ path).
+        points (pd.DataFrame or gpd.GeoDataFrame): Sample points, e.g. a CEO
+            project table. If a GeoDataFrame is provided, its point geometries
+            are used; otherwise, x_col and y_col are used with crs.
+        win_size (int): Window size in pixels (odd number, default 3).
+        bands (list): 1-based band indexes to extract (default: all bands).
+        band_names (list): Names used as column prefixes (default: band
+            descriptions of the stack, or b1, b2, ...).
+        nodata (float or list): Nodata value(s) for the bands (default: the
+            nodata values of the stack).
+        x_col (str): Column of x coordinates (default 'center_lon').
+        y_col (str): Column of y coordinates (default 'center_lat').
+        crs (str): CRS of x_col/y_col coordinates (default 'epsg:4326').
+
+    Returns:
+        pd.DataFrame: A copy of points with columns {name}_mean, {name}_std
+        and {name}_count appended for each band.
+    """
+    if win_size < 1 or win_size % 2 == 0:
+        raise ValueError(f'win_size must be a positive odd number, got '
+                         f'{win_size}.')
+
+    if isinstance(points, gpd.GeoDataFrame):
+        gdf = points
+    else:
+        gdf = gpd.GeoDataFrame(
+            points,
+            geometry=gpd.points_from_xy(points[x_col], points[y_col]),
+            crs=crs
+        )
+
+    with rasterio.open(stack) as dset:
+        if bands is None:
+            bands = list(range(1, dset.count + 1))
+        if band_names is None:
+            band_names = [dset.descriptions[b-1] or f'b{b}' for b in bands]
+        if len(band_names) != len(bands):
+            raise ValueError('band_names must have the same length as bands.')
+        if nodata is None:
+            nodata = [dset.nodatavals[b-1] for b in bands]
+        elif np.isscalar(nodata):
+            nodata = [nodata] * len(bands)
+
+        # Pixel row/col of each point in the stack
+        geom = gdf.geometry.to_crs(dset.crs)
+        cols, rows = ~dset.transform * (geom.x.to_numpy(), geom.y.to_numpy())
+        rows = np.floor(rows).astype(np.int64)
+        cols = np.floor(cols).astype(np.int64)
+
+        n = len(rows)
+        half = win_size // 2
+        mean = np.full((len(bands), n), np.nan)
+        std = np.full((len(bands), n), np.nan)
+        count = np.zeros((len(bands), n), dtype=np.int64)
+
+        # Only points whose window overlaps the raster can have valid pixels
+        inside = ((rows + half >= 0) & (rows - half < dset.height) &
+                  (cols + half >= 0) & (cols - half < dset.width))
+        idx = np.flatnonzero(inside)
+
+        # Group points by raster block
+        bh, bw = dset.block_shapes[0]
+        gh = _group_size(bh)
+        gw = _group_size(bw)
+        group = pd.Series(idx).groupby(
+            [np.clip(rows[idx], 0, dset.height - 1) // gh,
+             np.clip(cols[idx], 0, dset.width - 1) // gw]
+        )
+
+        offsets = np.arange(-half, half + 1)
+        for _, g in group:
+            g = g.to_numpy()
+            r = rows[g]
+            c = cols[g]
+
+            # Single read covering all windows of the group
+            r0 = max(r.min() - half, 0)
+            r1 = min(r.max() + half + 1, dset.height)
+            c0 = max(c.min() - half, 0)
+            c1 = min(c.max() + half + 1, dset.width)
+            block = dset.read(bands,
+                              window=Window(c0, r0, c1 - c0, r1 - r0),
+                              out_dtype=np.float64)
+
+            # Pad so that windows crossing the raster edge can be indexed
+            block = np.pad(block, ((0, 0), (half, half), (half, half)),
+                           constant_values=np.nan)
+
+            # Gather all windows of the group at once: (bands, points, N, N)
+            rr = (r - r0 + half)[:, None, None] + offsets[None, :, None]
+            cc = (c - c0 + half)[:, None, None] + offsets[None, None, :]
+            in_block = ((rr >= half) & (rr < r1 - r0 + half) &
+                        (cc >= half) & (cc < c1 - c0 + half))
+            rr = np.clip(rr, 0, block.shape[1] - 1)
+            cc = np.clip(cc, 0, block.shape[2] - 1)
+            windows = block[:, rr, cc]
+            windows[:, ~in_block] = np.nan
+
+            m, s, k = _window_stats(windows, nodata)
+            mean[:, g] = m
+            std[:, g] = s
+            count[:, g] = k
+
+    df = pd.DataFrame(points).copy()
+    for i, name in enumerate(band_names):
+        df[f'{name}_mean'] = mean[i]
+        df[f'{name}_std'] = std[i]
+        df[f'{name}_count'] = count[i]
+
+    return df
@@ -5,35 +5,63 @@ from pathlib import Path
 
 import numpy as np
 import rasterio
+from rasterio.enums import Resampling
+from rasterio.transform import Affine
+from rasterio.windows import Window
 
 
-def build_condensed_stack(stack_name, condensed_stack_name, stack_dir):
+def build_condensed_stack(stack_name, condensed_stack_name, stack_dir, res=None):
+    """
+    Build the condensed (RVI, NDVI and tree cover) version of the stacks. If res is set
+    (e.g. 60 or 120), bands are read at res from the overviews of the stacks.
+    """
     stack_dir = Path(stack_dir)
     stacks = sorted(stack_dir.glob(f'{stack_name}_h*v*.tif'))
     for stack_tif in stacks:
         print(f'Building condensed version of {stack_tif.name} ...')
         with rasterio.open(stack_tif) as dset:
+            read_opts = {}
+            profile = dset.profile
+            if res is not None and res > dset.res[0]:
+                # Window covering a whole number of output pixels of size res
+                factor_x = res / dset.res[0]
+                factor_y = res / dset.res[1]
+                width = int(dset.width / factor_x)
+                height = int(dset.height / factor_y)
+                read_opts = {
+                    'window': Window(0, 0, width * factor_x, height * factor_y),
+                    'out_shape': (height, width),
+                    'resampling': Resampling.average,
+                }
+                profile.update(width=width, height=height,
+                               transform=dset.transform * Affine.scale(factor_x, factor_y))
+
+            def read(band):
+                return dset.read(band, **read_opts)
+
+            def read_masks(band):
+                return dset.read_masks(band, **read_opts)
+
             # C-band RVI x 100
-            c_vv = dset.read(1)
-            c_vh = dset.read(2)
+            c_vv = read(1)
+            c_vh = read(2)
             c_rvi =  4 * c_vh / (c_vv + c_vh)
             c_rvi = np.round(c_rvi*100).astype(np.int16)
             c_rvi[c_vv == dset.nodata] = -9999
             c_rvi[c_vv + c_vh == 0] = -9999
             # L-band RVI x 100
-            l_hh = dset.read(4)
-            l_hv = dset.read(5)
+            l_hh = read(4)
+            l_hv = read(5)
             l_rvi =  4 * l_hv / (l_hh + l_hv)
             l_rvi = np.round(l_rvi*100).astype(np.int16)
             l_rvi[l_hh == dset.nodata] = -9999
             l_rvi[l_hh + l_hv == 0] = -9999
             # NDVI x 100
-            ndvi = np.round(dset.read(7)*100).astype(np.int16)
-            ndvi[dset.read_masks(7) == 0] = -9999
+            ndvi = np.round(read(7)*100).astype(np.int16)
+            ndvi[read_masks(7) == 0] = -9999
             # Percent Tree Cover
-            tc = dset.read(8).astype(np.int16)
-            tc[dset.read_masks(8) == 0] = -9999
-            profile = dset.profile
+            tc = read(8).astype(np.int16)
+            tc[read_masks(8) == 0] = -9999
 
         profile.update(dtype=np.int16, count=4, nodata=-9999)
 
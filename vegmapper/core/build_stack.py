@@ -7,7 +7,11 @@ import geopandas as gpd
 import rasterio
 
 
-def build_stack(stack_name, stack_dir, bands, tiles):
+def build_stack(stack_name, stack_dir, bands, tiles, res=None):
+    """
+    Stack the bands of each active tile into a COG. If res is set (e.g. 60 or 120), stacks
+    are made at res, averaged from the overviews of the band COGs when available.
+    """
     # Directory for VRTs of stacks
     stack_dir = Path(stack_dir)
     vrt_dir = stack_dir / 'vrt'
@@ -42,8 +46,14 @@ def build_stack(stack_name, stack_dir, bands, tiles):
 
         print(f'Making stack tif for h{h}v{v} ...')
         stack_tif = stack_dir / f'{stack_name}_h{h}v{v}.tif'
+        if res is None:
+            res_options = ''
+        else:
+            xmin, ymin, xmax, ymax = row['geometry'].bounds
+            res_options = f'-tr {res} {res} -te {xmin} {ymin} {xmax} {ymax} -r average '
         cmd = (f'gdalwarp '
                f'-overwrite '
+               f'{res_options}'
                f'-dstnodata -9999 '
                f'-ot Float32 '
                f'-of COG '
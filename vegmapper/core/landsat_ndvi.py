@@ -0,0 +1,215 @@
+#!/usr/bin/env python
+
+import argparse
+import tempfile
+import warnings
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import ExitStack
+from pathlib import Path
+
+import geopandas as gpd
+import numpy as np
+import rasterio
+from rasterio.enums import Resampling
+from rasterio.transform import from_origin
+from rasterio.vrt import WarpedVRT
+from rasterio.warp import transform_bounds
+from rasterio.windows import Window
+
+from vegmapper import pathurl
+from vegmapper.pathurl import ProjDir
+
+# Collection 2 QA_PIXEL bits 1, 3 and 4 are dilated cloud, cloud and cloud shadow, respectively.
+QA_CLOUD_MASK = (1 << 1) | (1 << 3) | (1 << 4)
+# Bit 0 of the QA band is set for fill pixels
+QA_FILL = 1
+
+# Landsat Collection 2 Level-2 surface reflectance scale factor and offset
+SR_SCALE = 0.0000275
+SR_OFFSET = -0.2
+
+
+def gdal_path(path):
+    path = str(path)
+    if path.startswith('s3://'):
+        return path.replace('s3://', '/vsis3/', 1)
+    elif path.startswith('gs://'):
+        return path.replace('gs://', '/vsigs/', 1)
+    return path
+
+
+def scene_files(scene):
+    # Band files of a Landsat C2 L2 scene, where scene is the path/URL prefix of the files, e.g.
+    # s3://bucket/LC08_L2SP_006066_20200716_20200912_02_T1/LC08_L2SP_006066_20200716_20200912_02_T1
+    scene = gdal_path(scene)
+    return f'{scene}_SR_B4.TIF', f'{scene}_SR_B5.TIF', f'{scene}_QA_PIXEL.TIF'
+
+
+def scene_year(scene):
+    # Acquisition year from the Landsat product ID (None if the name does not follow the convention)
+    fields = Path(str(scene)).name.split('_')
+    if len(fields) >= 4 and len(fields[3]) == 8 and fields[3].isdigit():
+        return int(fields[3][:4])
+    return None
+
+
+def clear_mask(qa):
+    # Pixels of a QA_PIXEL array that are neither fill, cloud (dilated or not) nor cloud shadow
+    return (qa & (QA_CLOUD_MASK | QA_FILL)) == 0
+
+
+def composite_tile(scenes, crs, bounds, res, out_tif, block_size=1024):
+    xmin, ymin, xmax, ymax = bounds
+    width = int(round((xmax - xmin) / res))
+    height = int(round((ymax - ymin) / res))
+    transform = from_origin(xmin, ymax, res, res)
+    grid = {'crs': crs, 'transform': transform, 'width': width, 'height': height}
+
+    profile = {
+        'driver': 'GTiff',
+        'width': width,
+        'height': height,
+        'count': 1,
+        'dtype': 'float32',
+        'crs': crs,
+        'transform': transform,
+        'nodata': np.nan,
+        'tiled': True,
+        'blockxsize': 512,
+        'blockysize': 512,
+        'compress': 'DEFLATE',
+        'predictor': 3,
+    }
+
+    with ExitStack() as stack:
+        # Scenes are warped onto the tile grid on the fly, so only the source pixels
+        # needed for each block are read
+        vrts = []
+        for scene in scenes:
+            b4, b5, qa = [stack.enter_context(rasterio.open(f)) for f in scene_files(scene)]
+            vrts.append((
+                stack.enter_context(WarpedVRT(b4, resampling=Resampling.bilinear, nodata=0, **grid)),
+                stack.enter_context(WarpedVRT(b5, resampling=Resampling.bilinear, nodata=0, **grid)),
+                stack.enter_context(WarpedVRT(qa, resampling=Resampling.nearest, nodata=QA_FILL, **grid)),
+            ))
+
+        with rasterio.open(out_tif, 'w', **profile) as dst:
+            for row in range(0, height, block_size):
+                for col in range(0, width, block_size):
+                    window = Window(col, row, min(block_size, width - col), min(block_size, height - row))
+                    ndvi = np.full((len(vrts), window.height, window.width), np.nan, dtype=np.float32)
+                    for k, (b4, b5, qa) in enumerate(vrts):
+                        q = qa.read(1, window=window)
+                        valid = clear_mask(q)
+                        if not valid.any():
+                            continue
+                        red = b4.read(1, window=window, out_dtype=np.float32)
+                        nir = b5.read(1, window=window, out_dtype=np.float32)
+                        valid &= (red > 0) & (nir > 0)
+                        red = red[valid] * SR_SCALE + SR_OFFSET
+                        nir = nir[valid] * SR_SCALE + SR_OFFSET
+                        with np.errstate(invalid='ignore', divide='ignore'):
+                            ndvi[k][valid] = (nir - red) / (nir + red)
+                    with warnings.catch_warnings():
+                        # All-NaN pixels (no clear observation) stay NaN
+                        warnings.simplefilter('ignore', category=RuntimeWarning)
+                        dst.write(np.nanmedian(ndvi, axis=0).astype(np.float32), 1, window=window)
+
+    return out_tif
+
+
+def composite_landsat_ndvi(proj_dir, sitename, tiles, res, year, scenes, n_workers=None, block_size=1024):
+    """
+    Local alternative to export_landsat_ndvi: per-pixel median of the NDVI of cloud-masked
+    Landsat C2 L2 scenes, computed on the prep_tiles grid. Tiles are processed in a process
+    pool and each tile is processed by blocks, so memory is bounded by
+    (number of scenes) x block_size^2 per worker. Outputs are saved with the same names as the
+    GEE exports (proj_dir/landsat/year/landsat_ndvi_{sitename}_{year}_h{h}v{v}.tif).
+
+    scenes: list of path/URL prefixes of the scene files ({scene}_SR_B4.TIF, {scene}_SR_B5.TIF
+            and {scene}_QA_PIXEL.TIF); scenes acquired in other years are ignored.
+    """
+    scenes = [s for s in scenes if scene_year(s) in [None, year]]
+    print(f'\nCompositing Landsat NDVI from {len(scenes)} scenes ...')
+
+    gdf_tiles = gpd.read_file(tiles)
+    crs = gdf_tiles.crs.to_wkt()
+
+    # Footprint of each scene in the tile CRS
+    footprints = []
+    for scene in scenes:
+        with rasterio.open(scene_files(scene)[0]) as dset:
+            footprints.append(transform_bounds(dset.crs, crs, *dset.bounds))
+
+    proj_dir = ProjDir(proj_dir)
+    dst_dir = proj_dir / 'landsat' / f'{year}'
+    with ExitStack() as stack:
+        if dst_dir.is_local:
+            out_dir = dst_dir.path
+            out_dir.mkdir(parents=True, exist_ok=True)
+        else:
+            # Removed once the outputs have been copied to dst_dir
+            out_dir = Path(stack.enter_context(tempfile.TemporaryDirectory()))
+
+        futures = {}
+        with ProcessPoolExecutor(n_workers) as pool:
+            for i in gdf_tiles.index:
+                h = gdf_tiles['h'][i]
+                v = gdf_tiles['v'][i]
+                m = gdf_tiles['mask'][i]
+                bounds = gdf_tiles['geometry'][i].bounds
+
+                if m != 1:
+                    print(f'#{i+1}: h{h}v{v} skipped')
+                    continue
+
+                tile_scenes = [s for s, b in zip(scenes, footprints)
+                               if b[0] < bounds[2] and b[2] > bounds[0] and b[1] < bounds[3] and b[3] > bounds[1]]
+                if not tile_scenes:
+                    print(f'#{i+1}: h{h}v{v} skipped (no scenes)')
+                    continue
+
+                out_tif = out_dir / f'landsat_ndvi_{sitename}_{year}_h{h}v{v}.tif'
+                futures[f'h{h}v{v}'] = pool.submit(composite_tile, tile_scenes, crs, bounds, res, out_tif, block_size)
+                print(f'#{i+1}: h{h}v{v} started ({len(tile_scenes)} scenes)')
+
+        out_tifs = []
+        for tile, future in futures.items():
+            if future.exception() is not None:
+                print(f'{tile} failed: {future.exception()}')
+                continue
+            out_tif = future.result()
+            if not dst_dir.is_local:
+                pathurl.copy(out_tif, dst_dir / out_tif.name, overwrite=True)
+                out_tif.unlink()
+                out_tif = dst_dir / out_tif.name
+            out_tifs.append(out_tif)
+            print(f'{tile} done: {out_tif}')
+
+        return out_tifs
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Composite Landsat NDVI locally from Landsat C2 L2 scenes'
+    )
+    parser.add_argument('proj_dir', type=str,
+                        help='project directory (s3:// or gs:// or local dirs)')
+    parser.add_argument('sitename', type=str,
+                        help='site name')
+    parser.add_argument('tiles', type=str,
+                        help=('shp/geojson file that contains tiles onto which '
+                              'the output raster will be resampled'))
+    parser.add_argument('res', type=int,
+                        help='resolution')
+    parser.add_argument('year', type=int,
+                        help='year of dataset')
+    parser.add_argument('scenes', type=str, nargs='+',
+                        help='path/URL prefixes of the Landsat C2 L2 scene files')
+    args = parser.parse_args()
+
+    composite_landsat_ndvi(args.proj_dir, args.sitename, args.tiles, args.res, args.year, args.scenes)
+
+
+if __name__ == '__main__':
+    main()
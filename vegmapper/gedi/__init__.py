@@ -1,5 +1,9 @@
 from .process_data import readH5Files
 from .process_data import divide_download_process_and_delete_h5_files
+from .process_data import download_and_process_h5_files
+from .process_data import read_gedi_shots
+from .grid_shots import grid_gedi_shots
 from .data_download import download_from_lpdaac
 from .data_download import delete_local_files
 from .data_download import divide_download_file
+from .data_download import download_h5
@@ -1,5 +1,6 @@
 import requests
 import os
+from requests.adapters import HTTPAdapter
 
 
 def download_from_lpdaac(h5_download_file, out_text_file_name, save_dir, token):
@@ -57,3 +58,36 @@ def divide_download_file(h5_download_file_in, save_dir):
 
 
 
+
+
+def lpdaac_session(token, pool_size=4):
+    # authenticated session with a connection pool shared by the download workers
+    session = requests.Session()
+    session.headers['Authorization'] = 'Bearer ' + token
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=3)
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    return session
+
+
+def download_h5(session, url, save_dir):
+    # download a single h5 file, written to a .part file first so that a partial download is never processed
+    download_file_name = url.split('/')[-1].strip()
+    saveName = os.path.join(save_dir, download_file_name)
+    partName = saveName + '.part'
+    try:
+        with session.get(url.strip(), stream=True) as response:
+            if response.status_code != 200:
+                raise Exception(f"{url.strip()} not downloaded (HTTP {response.status_code}), "
+                                f"check if you are using the correct credentials")
+            with open(partName, 'wb') as d:
+                for chunk in response.iter_content(chunk_size=1024 * 1024):
+                    d.write(chunk)
+        os.replace(partName, saveName)
+    except Exception:
+        # do not leave a partial download on disk
+        if os.path.exists(partName):
+            os.remove(partName)
+        raise
+    print('Downloaded file: {}'.format(saveName))
+    return saveName
@@ -0,0 +1,158 @@
+import os
+from glob import glob
+
+import geopandas as gpd
+import numpy as np
+import pandas as pd
+import pyarrow.dataset as ds
+import rasterio
+from pyproj import Transformer
+from rasterio.transform import from_origin
+
+
+class ShotGridder(object):
+    """
+    Streaming binning of GEDI shots onto the h/v tiles of prep_tiles.
+
+    Shots are added in batches (add), assigned to tiles and cells with integer
+    arithmetic on the tile grid, and accumulated as running sums and counts per
+    cell, so millions of shots can be gridded without holding them in memory.
+    Accumulators are only allocated for active tiles (mask == 1) hit by shots,
+    but layers are written for all active tiles.
+    """
+    def __init__(self, tiles, res=30, variables=('rh95',)):
+        gdf_tiles = gpd.read_file(tiles) if isinstance(tiles, str) else tiles
+        self.crs = gdf_tiles.crs
+        self.res = res
+        self.variables = list(variables)
+
+        # prep_tiles tiles are square, aligned and indexed from the upper left corner
+        xmin, _, xmax, ymax = gdf_tiles.total_bounds
+        b = gdf_tiles.geometry.iloc[0].bounds
+        self.t_size = b[2] - b[0]
+        self.xmin = xmin
+        self.ymax = ymax
+        self.n = int(round(self.t_size / res))
+        if not np.isclose(self.n * res, self.t_size):
+            raise ValueError(f'Tile size {self.t_size} is not a multiple of res {res}.')
+
+        self.nh = gdf_tiles['h'].max() + 1
+        self.nv = gdf_tiles['v'].max() + 1
+        self.active = np.zeros((self.nh, self.nv), dtype=bool)
+        m = gdf_tiles['mask'] == 1 if 'mask' in gdf_tiles.columns else slice(None)
+        self.active[gdf_tiles.loc[m, 'h'], gdf_tiles.loc[m, 'v']] = True
+
+        self.transformer = Transformer.from_crs('EPSG:4326', self.crs, always_xy=True)
+        self.sums = {}
+        self.counts = {}
+
+    def add(self, lon, lat, values):
+        """
+        Add a batch of shots.
+
+        lon, lat: arrays of shot coordinates (EPSG:4326)
+        values: dict (or DataFrame) of arrays for each variable
+        """
+        vals = {var: np.asarray(values[var], dtype=np.float64) for var in self.variables}
+        x, y = self.transformer.transform(np.asarray(lon), np.asarray(lat))
+        col = np.floor((x - self.xmin) / self.res).astype(np.int64)
+        row = np.floor((self.ymax - y) / self.res).astype(np.int64)
+        h = col // self.n
+        v = row // self.n
+        keep = (h >= 0) & (h < self.nh) & (v >= 0) & (v < self.nv)
+        for var in self.variables:
+            keep &= ~np.isnan(vals[var])
+        keep[keep] = self.active[h[keep], v[keep]]
+        if not keep.any():
+            return
+
+        h = h[keep]
+        v = v[keep]
+        cell = (row[keep] % self.n) * self.n + (col[keep] % self.n)
+
+        # Shots are grouped by tile and binned with bincount
+        tile_id = v * self.nh + h
+        order = np.argsort(tile_id, kind='stable')
+        tile_id = tile_id[order]
+        cell = cell[order]
+        vals = {var: vals[var][keep][order] for var in self.variables}
+        starts = np.r_[0, np.flatnonzero(np.diff(tile_id)) + 1]
+        stops = np.r_[starts[1:], len(tile_id)]
+        for s, e in zip(starts, stops):
+            key = (int(tile_id[s] % self.nh), int(tile_id[s] // self.nh))
+            if key not in self.counts:
+                self.counts[key] = np.zeros(self.n * self.n, dtype=np.uint32)
+                self.sums[key] = {var: np.zeros(self.n * self.n) for var in self.variables}
+            c = cell[s:e]
+            for var in self.variables:
+                self.sums[key][var] += np.bincount(c, weights=vals[var][s:e], minlength=self.n * self.n)
+            self.counts[key] += np.bincount(c, minlength=self.n * self.n).astype(np.uint32)
+
+    def write(self, out_dir, prefix='gedi_'):
+        """
+        Write the gridded layers of each tile as single-band COGs named
+        {prefix}h{h}v{v}_{var}_mean.tif and {prefix}h{h}v{v}_count.tif, which
+        build_stack can use as bands with prefix and suffix (e.g. '_rh95_mean.tif').
+        Layers are written for every active tile, so build_stack finds them for all
+        tiles: tiles without shots get NaN means and zero counts.
+        """
+        os.makedirs(out_dir, exist_ok=True)
+        out_files = []
+        empty_count = np.zeros(self.n * self.n, dtype=np.uint32)
+        empty_sums = {var: np.zeros(self.n * self.n) for var in self.variables}
+        for h, v in sorted(map(tuple, np.argwhere(self.active).tolist())):
+            count = self.counts.get((h, v), empty_count)
+            sums = self.sums.get((h, v), empty_sums)
+            x0 = self.xmin + h * self.t_size
+            y0 = self.ymax - v * self.t_size
+            profile = {
+                'driver': 'COG',
+                'width': self.n,
+                'height': self.n,
+                'count': 1,
+                'dtype': 'float32',
+                'crs': self.crs,
+                'transform': from_origin(x0, y0, self.res, self.res),
+                'nodata': np.nan,
+                'compress': 'DEFLATE',
+                'predictor': 3,
+            }
+            layers = {'count': count}
+            for var in self.variables:
+                with np.errstate(invalid='ignore', divide='ignore'):
+                    layers[f'{var}_mean'] = sums[var] / count
+            for name, layer in layers.items():
+                out_tif = os.path.join(out_dir, f'{prefix}h{h}v{v}_{name}.tif')
+                with rasterio.open(out_tif, 'w', **profile) as dset:
+                    dset.write(layer.reshape(self.n, self.n).astype(np.float32), 1)
+                    dset.set_band_description(1, name)
+                out_files.append(out_tif)
+            print(f'Gridded GEDI layers for h{h}v{v}: {int((count > 0).sum())} cells with shots')
+        return out_files
+
+
+def grid_gedi_shots(tiles, shots, out_dir, res=30, variables=('rh95',), prefix='gedi_', batch_size=1000000):
+    """
+    Grid processed GEDI shots onto the prep_tiles tiles and write per-tile COGs
+    (mean of each variable and shot count per cell).
+
+    tiles: tiles geojson from prep_tiles
+    shots: parquet dataset directory (output_format='parquet') or a directory/list of processed csv files
+    res: cell size in meters (use the stack resolution, e.g. 30, for layers consumed by build_stack)
+    """
+    gridder = ShotGridder(tiles, res, variables)
+    columns = ['lats', 'long'] + list(variables)
+
+    if isinstance(shots, str) and os.path.isdir(shots) and not glob(os.path.join(shots, '*.csv')):
+        dataset = ds.dataset(shots, format='parquet', partitioning='hive')
+        for batch in dataset.to_batches(columns=columns, batch_size=batch_size):
+            df = batch.to_pandas()
+            gridder.add(df['long'], df['lats'], df)
+    else:
+        if isinstance(shots, str):
+            shots = sorted(glob(os.path.join(shots, '*.csv'))) if os.path.isdir(shots) else [shots]
+        for csv_file in shots:
+            for df in pd.read_csv(csv_file, usecols=columns, chunksize=batch_size):
+                gridder.add(df['long'], df['lats'], df)
+
+    return gridder.write(out_dir, prefix)
@@ -1,11 +1,22 @@
 import os
+import json
+import multiprocessing
+import threading
+import geopandas as gpd
 import h5py
 import numpy as np
 import pandas as pd
+import pyarrow as pa
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
+import shapely
+import shutil
 import warnings
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
 from datetime import datetime,timedelta
+from functools import partial
 
-from .data_download import download_from_lpdaac, delete_local_files, divide_download_file
+from .data_download import download_from_lpdaac, delete_local_files, divide_download_file, lpdaac_session, download_h5
 
 pd.options.mode.chained_assignment = None
 warnings.filterwarnings("ignore")
@@ -16,7 +27,60 @@ warnings.filterwarnings("ignore")
 #destinationDirectory = r"C:\Users\conductor\Desktop\Oil_Palm_Mapping\cmr_spatial_query_demo\DDD_demo\daac_data_download_python\output_test1"
 
 
-def saveFilteredData(GEDI_DF, h5file, csv_files):
+# Name of the partitioned parquet dataset (created next to the h5 files) when output_format is 'parquet'
+PARQUET_DIR = "gedi_shots"
+
+# Maximum number of rows per parquet row group
+PARQUET_ROW_GROUP_SIZE = 131072
+
+
+def gediArrowTable(GEDI_DF):
+    # convert the filtered dataframe to an arrow table with compact dtypes and the acq_date partition key.
+    # shots are sorted by beam, so row group statistics on beam allow filtering beams on read
+    df = GEDI_DF.sort_values(by=['beam', 'shotNumber'], kind='stable').reset_index(drop=True)
+    rh_cols = [c for c in df.columns if c.startswith('rh') and c[2:].isdigit()]
+    df[rh_cols] = df[rh_cols].astype(np.float32)
+    df['shotNumber'] = df['shotNumber'].astype(np.int64)
+    df['acq_date'] = df['date'].dt.strftime('%Y-%m-%d')
+    return pa.Table.from_pandas(df, preserve_index=False)
+
+
+def saveParquetData(GEDI_DF, h5file, out_files):
+    # append the filtered shots of a granule to the parquet dataset partitioned by acquisition date, with one
+    # file per granule and date. files are named after the granule, so re-processing a granule overwrites its
+    # own files only. the granule is added to out_files even if it has no shots left (nothing is written).
+    dataset_dir = os.path.join(os.path.dirname(h5file), PARQUET_DIR)
+    granule = os.path.basename(h5file)[:-3]
+    out_files.append(granule)
+    if GEDI_DF.empty:
+        print(f"NO SHOTS LEFT IN {granule}")
+        return
+    print(f"WRITING {granule} TO PARQUET DATASET: {dataset_dir}")
+    pq.write_to_dataset(gediArrowTable(GEDI_DF), dataset_dir,
+                        partition_cols=['acq_date'],
+                        basename_template=f'{granule}-{{i}}.parquet',
+                        existing_data_behavior='overwrite_or_ignore',
+                        max_rows_per_group=PARQUET_ROW_GROUP_SIZE)
+
+
+def read_gedi_shots(dataset_dir, columns=None, filters=None):
+    """
+    Read processed GEDI shots from a parquet dataset written with output_format='parquet'.
+
+    Only the requested columns are read and filters are pushed down to the acq_date
+    partitions and to the row group statistics (e.g. of beam), e.g.
+        read_gedi_shots(dataset_dir, columns=['lats', 'long', 'rh95'],
+                        filters=[('acq_date', '>=', '2020-01-01'), ('rh95', '>', 5)])
+    """
+    return pq.read_table(dataset_dir, columns=columns, filters=filters,
+                         partitioning=ds.partitioning(pa.schema([('acq_date', pa.string())]),
+                                                      flavor='hive')).to_pandas()
+
+
+def saveFilteredData(GEDI_DF, h5file, csv_files, output_format='csv'):
+    if output_format == 'parquet':
+        saveParquetData(GEDI_DF, h5file, csv_files)
+        return
     # save final filtered dataframe to a csv file in the destination directory with the correct prefix
     csv_file = os.path.join(h5file[:-3] + ".csv")
     csv_files.append(csv_file)
@@ -24,18 +88,18 @@ def saveFilteredData(GEDI_DF, h5file, csv_files):
     GEDI_DF.to_csv(csv_file)
 
 
-def filterBeamData(all_beam_dfs, h5file, csv_files):
+def filterBeamData(all_beam_dfs, h5file, csv_files, output_format='csv'):
     try:
-        filtered = all_beam_dfs[all_beam_dfs.sensitivity >= 0.9]  # sensitivity > 90%
+        filtered = all_beam_dfs[all_beam_dfs.sensitivity >= MIN_SENSITIVITY]  # sensitivity > 90%
 
         # filter based on elevation
         elevs = pd.concat(
             [filtered.elev1, filtered.elev2, filtered.elev3, filtered.elev4, filtered.elev5, filtered.elev6])
         filtered['elev_sd'] = elevs.std()
         filtered['elev_mean'] = elevs.mean()  # calculate mean of elevs
-        filtered['elev_range'] = filtered.apply(
-            lambda x: rangeCalculator([x['elev1'], x['elev2'], x['elev3'], x['elev4'], x['elev5'], x['elev6']],
-                                      x['elev_sd'], x['elev_mean']), axis=1)
+        filtered['elev_range'] = elevRangeCalculator(
+            filtered[['elev1', 'elev2', 'elev3', 'elev4', 'elev5', 'elev6']].to_numpy(),
+            filtered['elev_sd'].to_numpy(), filtered['elev_mean'].to_numpy())
 
         GEDI_DF = filtered[abs(filtered.elev_range) < 2]  # only select rows that have valid ranges
 
@@ -44,7 +108,7 @@ def filterBeamData(all_beam_dfs, h5file, csv_files):
         print("EXCEPTION: ", e)
         return
     else:
-        saveFilteredData(GEDI_DF, h5file, csv_files)
+        saveFilteredData(GEDI_DF, h5file, csv_files, output_format)
 
 
 # returns the range between valid elevations (elevations that are within 2SD of the mean)
@@ -57,66 +121,140 @@ def rangeCalculator(elevList, sd, mean):
         return 99
 
 
-def extractBeamData(highBeam, gediL2A, rh_cols):
-    gedi_beam_data = {}
+# vectorized version of rangeCalculator over a (shots x 6) matrix of elevations
+def elevRangeCalculator(elevs, sd, mean):
+    sd = np.asarray(sd, dtype=np.float64).reshape(-1, 1)
+    mean = np.asarray(mean, dtype=np.float64).reshape(-1, 1)
+    valid = (elevs <= (mean + (2 * sd))) & (elevs >= (mean - (2 * sd)))
+    elev_range = np.full(elevs.shape[0], 99, dtype=np.float64)
+    rows = valid.any(axis=1)
+    if rows.any():
+        elevs = elevs[rows]
+        valid = valid[rows]
+        elev_max = np.where(valid, elevs, -np.inf).max(axis=1)
+        elev_min = np.where(valid, elevs, np.inf).min(axis=1)
+        elev_range[rows] = elev_max - elev_min
+    return elev_range
+
+
+# Datasets extracted for each beam: (column name, dataset path within the beam group).
+# Only the datasets listed here are read from the granule.
+BEAM_FIELDS = [
+    ("lats", "lat_lowestmode"),
+    ("long", "lon_lowestmode"),
+    ("shotNumber", "shot_number"),
+    ("quality", "quality_flag"),
+    ("solar_elev", "solar_elevation"),
+    ("sensitivity", "sensitivity"),
+    ("elevLow", "elev_lowestmode"),
+    ("delta_time", "delta_time"),
+    ("energy_total", "energy_total"),
+    ("rx_gbias", "rx_1gaussfit/rx_gbias"),
+    ("rx_gamplitude_error", "rx_1gaussfit/rx_gamplitude_error"),
+    *[(f"rx{a}_energy_sm", f"rx_processing_a{a}/energy_sm") for a in range(1, 7)],
+    *[(f"rx{a}_lastmodeenergy", f"rx_processing_a{a}/lastmodeenergy") for a in range(1, 7)],
+    *[(f"elev{a}_low_energy", f"geolocation/energy_lowestmode_a{a}") for a in range(1, 7)],
+    *[(f"elev{a}_num_modes", f"geolocation/num_detectedmodes_a{a}") for a in range(1, 7)],
+    *[(f"elev{a}", f"geolocation/elev_lowestmode_a{a}") for a in range(1, 7)],
+]
+
+# Minimum sensitivity of the shots kept (see filterBeamData)
+MIN_SENSITIVITY = 0.9
+
+# Number of rows read at once from 2-D datasets (rh)
+READ_CHUNK_ROWS = 65536
+
+
+def maskRanges(mask, max_gap=READ_CHUNK_ROWS):
+    # (start, stop) index ranges covering the selected rows of a boolean mask.
+    # runs of selected rows separated by less than max_gap rows are merged into one range.
+    idx = np.flatnonzero(mask)
+    if len(idx) == 0:
+        return []
+    breaks = np.flatnonzero(np.diff(idx) > max_gap)
+    starts = np.r_[idx[0], idx[breaks + 1]]
+    stops = np.r_[idx[breaks], idx[-1]] + 1
+    return list(zip(starts.tolist(), stops.tolist()))
+
+
+def readMasked(dataset, mask, chunk_rows=READ_CHUNK_ROWS):
+    # read the rows of an h5 dataset selected by a boolean mask into a pre-allocated array.
+    # only the index ranges containing selected rows are read (h5py slicing), and 2-D datasets
+    # are read in chunks of rows so that only the selected rows are held in memory.
+    out = np.empty((int(mask.sum()),) + dataset.shape[1:], dtype=dataset.dtype)
+    pos = 0
+    for start, stop in maskRanges(mask, chunk_rows):
+        step = chunk_rows if dataset.ndim > 1 else stop - start
+        for s in range(start, stop, step):
+            e = min(s + step, stop)
+            m = mask[s:e]
+            k = int(m.sum())
+            if k:
+                out[pos:pos + k] = dataset[s:e][m]
+                pos += k
+    return out
+
+
+def prepareAOI(aoi):
+    # AOI geometry (lon/lat) used to subset the shots before extraction. aoi can be a shapely
+    # geometry in EPSG:4326, a GeoDataFrame or a vector file (shp/geojson). For a tile index from
+    # prep_tiles, only the tiles with mask == 1 are used.
+    if aoi is None:
+        return None
+    if isinstance(aoi, shapely.Geometry):
+        geom = aoi
+    else:
+        gdf = aoi if isinstance(aoi, gpd.GeoDataFrame) else gpd.read_file(aoi)
+        if 'mask' in gdf.columns:
+            gdf = gdf[gdf['mask'] == 1]
+        geom = gdf.to_crs('EPSG:4326').geometry.union_all()
+    shapely.prepare(geom)
+    return geom
+
+
+def aoiMask(beam, aoi):
+    # vectorized point-in-polygon test of the shot locations, reading only lat/lon
+    lat = beam['lat_lowestmode'][()]
+    lon = beam['lon_lowestmode'][()]
+    xmin, ymin, xmax, ymax = aoi.bounds
+    mask = (lon >= xmin) & (lon <= xmax) & (lat >= ymin) & (lat <= ymax)
+    if mask.any():
+        mask[mask] = shapely.contains_xy(aoi, lon[mask], lat[mask])
+    return mask
+
+
+def shotMask(beam, quality_only=False, min_sensitivity=MIN_SENSITIVITY, aoi=None):
+    # pre-filter mask computed from the shot locations (if aoi is given) and the small
+    # quality/sensitivity datasets, applied before reading the other datasets of the beam
+    if aoi is not None:
+        mask = aoiMask(beam, aoi)
+    else:
+        mask = np.ones(beam['sensitivity'].shape[0], dtype=bool)
+    if mask.any():
+        keep = readMasked(beam['sensitivity'], mask) >= min_sensitivity
+        if quality_only:
+            keep &= readMasked(beam['quality_flag'], mask) == 1
+        mask[mask] = keep
+    return mask
+
+
+def extractBeamData(highBeam, gediL2A, rh_cols, quality_only=False, min_sensitivity=MIN_SENSITIVITY, aoi=None):
     # Start date as January 1, 2018 (manually set the start date/the time gedi staretd collecting data)
     start_date = datetime(2018, 1, 1)
     try:
-        gedi_beam_data["lats"] = gediL2A[f'{highBeam}/lat_lowestmode'][()]
-        gedi_beam_data["long"] = gediL2A[f'{highBeam}/lon_lowestmode'][()]
-        gedi_beam_data["shotNumber"] = gediL2A[f'{highBeam}/shot_number'][()]
-        gedi_beam_data["quality"] = gediL2A[f'{highBeam}/quality_flag'][()]
-        gedi_beam_data["solar_elev"] = gediL2A[f'{highBeam}/solar_elevation'][()]
-        gedi_beam_data["sensitivity"] = gediL2A[f'{highBeam}/sensitivity'][()]
-        # gedi_beam_data["rh"] = gediL2A[f'{highBeam}/rh'][()]
-        gedi_beam_data["elevLow"] = gediL2A[f'{highBeam}/elev_lowestmode'][()]
-
-        gedi_beam_data["delta_time"] = gediL2A[f'{highBeam}/delta_time'][()]
-        gedi_beam_data['date'] = start_date + pd.to_timedelta(gedi_beam_data['delta_time'], unit='s')
-        gedi_beam_data["energy_total"] = gediL2A[f'{highBeam}/energy_total'][()]
-
-        gedi_beam_data["rx_gbias"] = gediL2A[f'{highBeam}/rx_1gaussfit/rx_gbias'][()]
-        gedi_beam_data["rx_gamplitude_error"] = gediL2A[f'{highBeam}/rx_1gaussfit/rx_gamplitude_error'][()]
-
-        gedi_beam_data["rx1_energy_sm"] = gediL2A[f'{highBeam}/rx_processing_a1/energy_sm'][()]
-        gedi_beam_data["rx2_energy_sm"] = gediL2A[f'{highBeam}/rx_processing_a2/energy_sm'][()]
-        gedi_beam_data["rx3_energy_sm"] = gediL2A[f'{highBeam}/rx_processing_a3/energy_sm'][()]
-        gedi_beam_data["rx4_energy_sm"] = gediL2A[f'{highBeam}/rx_processing_a4/energy_sm'][()]
-        gedi_beam_data["rx5_energy_sm"] = gediL2A[f'{highBeam}/rx_processing_a5/energy_sm'][()]
-        gedi_beam_data["rx6_energy_sm"] = gediL2A[f'{highBeam}/rx_processing_a6/energy_sm'][()]
-
-        gedi_beam_data["rx1_lastmodeenergy"] = gediL2A[f'{highBeam}/rx_processing_a1/lastmodeenergy'][()]
-        gedi_beam_data["rx2_lastmodeenergy"] = gediL2A[f'{highBeam}/rx_processing_a2/lastmodeenergy'][()]
-        gedi_beam_data["rx3_lastmodeenergy"] = gediL2A[f'{highBeam}/rx_processing_a3/lastmodeenergy'][()]
-        gedi_beam_data["rx4_lastmodeenergy"] = gediL2A[f'{highBeam}/rx_processing_a4/lastmodeenergy'][()]
-        gedi_beam_data["rx5_lastmodeenergy"] = gediL2A[f'{highBeam}/rx_processing_a5/lastmodeenergy'][()]
-        gedi_beam_data["rx6_lastmodeenergy"] = gediL2A[f'{highBeam}/rx_processing_a6/lastmodeenergy'][()]
-
-        gedi_beam_data["elev1_low_energy"] = gediL2A[f'{highBeam}/geolocation/energy_lowestmode_a1'][()]
-        gedi_beam_data["elev2_low_energy"] = gediL2A[f'{highBeam}/geolocation/energy_lowestmode_a2'][()]
-        gedi_beam_data["elev3_low_energy"] = gediL2A[f'{highBeam}/geolocation/energy_lowestmode_a3'][()]
-        gedi_beam_data["elev4_low_energy"] = gediL2A[f'{highBeam}/geolocation/energy_lowestmode_a4'][()]
-        gedi_beam_data["elev5_low_energy"] = gediL2A[f'{highBeam}/geolocation/energy_lowestmode_a5'][()]
-        gedi_beam_data["elev6_low_energy"] = gediL2A[f'{highBeam}/geolocation/energy_lowestmode_a6'][()]
-
-        gedi_beam_data["elev1_num_modes"] = gediL2A[f'{highBeam}/geolocation/num_detectedmodes_a1'][()]
-        gedi_beam_data["elev2_num_modes"] = gediL2A[f'{highBeam}/geolocation/num_detectedmodes_a2'][()]
-        gedi_beam_data["elev3_num_modes"] = gediL2A[f'{highBeam}/geolocation/num_detectedmodes_a3'][()]
-        gedi_beam_data["elev4_num_modes"] = gediL2A[f'{highBeam}/geolocation/num_detectedmodes_a4'][()]
-        gedi_beam_data["elev5_num_modes"] = gediL2A[f'{highBeam}/geolocation/num_detectedmodes_a5'][()]
-        gedi_beam_data["elev6_num_modes"] = gediL2A[f'{highBeam}/geolocation/num_detectedmodes_a6'][()]
-
-        gedi_beam_data["elev1"] = gediL2A[f'{highBeam}/geolocation/elev_lowestmode_a1'][()]
-        gedi_beam_data["elev2"] = gediL2A[f'{highBeam}/geolocation/elev_lowestmode_a2'][()]
-        gedi_beam_data["elev3"] = gediL2A[f'{highBeam}/geolocation/elev_lowestmode_a3'][()]
-        gedi_beam_data["elev4"] = gediL2A[f'{highBeam}/geolocation/elev_lowestmode_a4'][()]
-        gedi_beam_data["elev5"] = gediL2A[f'{highBeam}/geolocation/elev_lowestmode_a5'][()]
-        gedi_beam_data["elev6"] = gediL2A[f'{highBeam}/geolocation/elev_lowestmode_a6'][()]
-        rh = gediL2A[f'{highBeam}/rh'][()]
-        gedi_beam_data["beam"] = np.full(len(gedi_beam_data['shotNumber']), highBeam)
-
-        raw_df = pd.DataFrame(gedi_beam_data)
-        raw_df[rh_cols] = pd.DataFrame(rh, index=raw_df.index)  # add rh values
+        beam = gediL2A[highBeam]
+        mask = shotMask(beam, quality_only, min_sensitivity, aoi)
+
+        gedi_beam_data = {}
+        for col, path in BEAM_FIELDS:
+            gedi_beam_data[col] = readMasked(beam[path], mask)
+            if col == "delta_time":
+                gedi_beam_data["date"] = start_date + pd.to_timedelta(gedi_beam_data["delta_time"], unit='s')
+        gedi_beam_data["beam"] = np.full(len(gedi_beam_data["shotNumber"]), highBeam)
+
+        rh = readMasked(beam['rh'], mask)
+        raw_df = pd.concat([pd.DataFrame(gedi_beam_data),
+                            pd.DataFrame(rh, columns=rh_cols)], axis=1)  # add rh values
         raw_df = raw_df.dropna()
     except Exception as e:
         print("EXCEPTION: ", e)
@@ -125,32 +263,43 @@ def extractBeamData(highBeam, gediL2A, rh_cols):
         return raw_df
 
 
-def processBeams(gediL2A, h5file, csv_files, rh_cols):
+def emptyShotFrame(rh_cols):
+    # dataframe with the columns of the filtered shots (see extractBeamData and filterBeamData) and no rows
+    cols = []
+    for col, _ in BEAM_FIELDS:
+        cols.append(col)
+        if col == "delta_time":
+            cols.append("date")
+    cols += ["beam"] + rh_cols + ["elev_sd", "elev_mean", "elev_range"]
+    return pd.DataFrame(columns=cols)
+
+
+def processBeams(gediL2A, h5file, csv_files, rh_cols, quality_only=False, output_format='csv', aoi=None):
     ## approx 4 beams in every file
     beamNames = [g for g in gediL2A.keys() if g.startswith('BEAM')]
     beam_dfs = []  # create list to hold resulting dataframes for each beam
-
-    gediL2A_objs = []
-    gediL2A.visit(gediL2A_objs.append)  # Retrieve list of datasets
-    gediSDS = [o for o in gediL2A_objs if
-               isinstance(gediL2A[o], h5py.Dataset)]  # Search for relevant SDS inside data file
+    beam_failed = False
 
     for highBeam in beamNames:  # extract data from each beam in the shot
-        beam_df = extractBeamData(highBeam, gediL2A, rh_cols)
-        if not beam_df.empty:  # if beam data extraction is successful, append resulting dataframe to list
+        beam_df = extractBeamData(highBeam, gediL2A, rh_cols, quality_only, aoi=aoi)
+        if beam_df is None:
+            beam_failed = True
+        elif not beam_df.empty:  # if beam data extraction is successful, append resulting dataframe to list
             beam_dfs.append(beam_df)
 
-    if len(beam_dfs) >= 2:
-        all_beam_dfs = pd.concat(beam_dfs)  # combine all beam dataframes
-        filterBeamData(all_beam_dfs, h5file, csv_files)
-    elif len(beam_dfs) == 1:
-        filterBeamData(beam_dfs, h5file, csv_files)
-    else:
-        return
+    if beam_dfs:
+        all_beam_dfs = pd.concat(beam_dfs, ignore_index=True)  # combine all beam dataframes
+        filterBeamData(all_beam_dfs, h5file, csv_files, output_format)
+    elif not beam_failed:
+        # no shot in the AOI (or passing the pre-filter): an empty output records that the granule
+        # has been processed, so it is not downloaded again when a run is resumed
+        saveFilteredData(emptyShotFrame(rh_cols), h5file, csv_files, output_format)
 
 
-def readH5Files(h5FilesToProcess, sourceDirectory):
+def readH5Files(h5FilesToProcess, sourceDirectory, quality_only=False, output_format='csv', aoi=None):
+    # with aoi (see prepareAOI), only the shots inside the AOI are extracted
     csv_files = []  ## list that keeps track of all csv files generated
+    aoi = prepareAOI(aoi)
 
     ##generate column names for rh vals (ranges 1-100)
     rh_cols = []
@@ -169,10 +318,146 @@ def readH5Files(h5FilesToProcess, sourceDirectory):
             print(e)
             os.remove(h5file)
         else:
-            processBeams(gediL2A, h5file, csv_files, rh_cols)
+            with gediL2A:
+                processBeams(gediL2A, h5file, csv_files, rh_cols, quality_only, output_format, aoi)
+
+    # outputs produced (csv files, or granules written to the parquet dataset)
+    return csv_files
+
+
+def processH5File(h5file, quality_only=False, output_format='csv', aoi=None):
+    # process a single granule, run in the process pool of download_and_process_h5_files
+    rh_cols = [f'rh{i}' for i in range(101)]
+    out_files = []
+    aoi = prepareAOI(aoi)
+    with h5py.File(h5file, 'r') as gediL2A:
+        processBeams(gediL2A, h5file, out_files, rh_cols, quality_only, output_format, aoi)
+    return out_files
+
+
+def readLedger(ledger_file):
+    # granules recorded as done in the ledger of a previous (possibly interrupted) run
+    done = set()
+    if os.path.exists(ledger_file):
+        with open(ledger_file) as fr:
+            for line in fr:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    continue  # partially written last line
+                if record['status'] == 'done':
+                    done.add(record['granule'])
+                else:
+                    done.discard(record['granule'])
+    return done
+
+
+def download_and_process_h5_files(h5_download_file, work_dir, runName, token, n_downloads=4, n_processes=None,
+                                  max_h5_on_disk=8, output_format='csv', quality_only=False, aoi=None):
+    """
+    Download and process the GEDI L2A granules listed in h5_download_file concurrently.
+
+    n_downloads threads share one authenticated session and feed a pool of n_processes h5 parsers.
+    At most max_h5_on_disk h5 files are downloaded but not yet processed and deleted at any time,
+    which bounds the disk footprint of the run. Each finished granule is appended to the ledger
+    <runName>_ledger.jsonl in the run directory; granules recorded as done are skipped when the
+    function is run again, so an interrupted run can be resumed. With aoi (a geometry in EPSG:4326,
+    a vector file or a prep_tiles tile index), only the shots inside the AOI are extracted, and granules
+    without any shot inside the AOI produce an empty output (and are recorded as done).
+    """
 
+    #Verify that the h5 download file exists, if not error eout of the function
+    assert os.path.exists(h5_download_file), f"Input H5 file not found! {h5_download_file}"
 
-def divide_download_process_and_delete_h5_files(h5_download_file, work_dir, runName, token):
+    save_dir = os.path.join(work_dir, runName)
+    if not os.path.exists(save_dir):
+        os.mkdir(save_dir)
+    ledger_file = os.path.join(save_dir, f'{runName}_ledger.jsonl')
+
+    with open(h5_download_file) as fr:
+        urls = [url.strip() for url in fr.readlines() if url.strip()]
+    done = readLedger(ledger_file)
+    todo = [url for url in urls if url.split('/')[-1].split('.')[0] not in done]
+    print(f' Files will be processed in {save_dir}')
+    print(f'ledger for {runName}: {ledger_file}')
+    print(f'{len(urls) - len(todo)}/{len(urls)} files already processed, {len(todo)} files to process')
+
+    aoi = prepareAOI(aoi)
+    session = lpdaac_session(token, n_downloads)
+    on_disk = threading.Semaphore(max_h5_on_disk)
+    lock = threading.Lock()
+    counts = {'done': 0, 'failed': 0}
+
+    def finish(url, h5file, status, message=''):
+        granule = url.split('/')[-1].split('.')[0]
+        if h5file is not None and os.path.exists(h5file):
+            os.remove(h5file)
+        with lock:
+            counts[status] += 1
+            with open(ledger_file, 'a') as fw:
+                fw.write(json.dumps({'granule': granule, 'url': url, 'status': status,
+                                     'message': message, 'time': datetime.now().isoformat()}) + '\n')
+            print(f'<----{status.upper()} {granule} '
+                  f'({counts["done"] + counts["failed"]}/{len(todo)}) {message}---->')
+
+    # h5 parsers are submitted from the download threads: workers are spawned rather than forked
+    # from this multithreaded process, which can deadlock
+    with ThreadPoolExecutor(n_downloads) as download_pool, \
+            ProcessPoolExecutor(n_processes, mp_context=multiprocessing.get_context('spawn')) as process_pool:
+
+        # the room taken on disk by a granule is released by the last callback of the granule, even if
+        # the callback fails, as a leaked release would deadlock the run
+        def processed(url, h5file, future):
+            try:
+                if future.exception() is not None:
+                    finish(url, h5file, 'failed', str(future.exception()))
+                elif not future.result():
+                    finish(url, h5file, 'failed', f'no {output_format} output produced')
+                else:
+                    finish(url, h5file, 'done')
+            finally:
+                on_disk.release()
+
+        def downloaded(url, future):
+            submitted = False
+            try:
+                if future.exception() is not None:
+                    finish(url, None, 'failed', str(future.exception()))
+                    return
+                h5file = future.result()
+                try:
+                    process_future = process_pool.submit(processH5File, h5file, quality_only, output_format, aoi)
+                except Exception as e:
+                    finish(url, h5file, 'failed', str(e))
+                else:
+                    submitted = True
+                    process_future.add_done_callback(partial(processed, url, h5file))
+            finally:
+                if not submitted:
+                    on_disk.release()
+
+        for url in todo:
+            on_disk.acquire()  # wait until there is room for another h5 file on disk
+            try:
+                download_future = download_pool.submit(download_h5, session, url, save_dir)
+            except Exception:
+                on_disk.release()
+                raise
+            download_future.add_done_callback(partial(downloaded, url))
+
+        # wait for all granules to be processed and deleted
+        for _ in range(max_h5_on_disk):
+            on_disk.acquire()
+
+    print(f'##### PROCESSING COMPLETE, Successfully processed {counts["done"]}/{len(todo)} files, '
+          f'see details in ledger located at {ledger_file}')
+
+
+def divide_download_process_and_delete_h5_files(h5_download_file, work_dir, runName, token,
+                                                output_format='csv', append=True, aoi=None):
+    # output_format: 'csv' (one csv per granule) or 'parquet' (one dataset partitioned by
+    # acquisition date and beam, see read_gedi_shots). With append=False an existing parquet
+    # dataset of the run is removed first. With aoi, only the shots inside the AOI are extracted.
 
     #Verify that the h5 download file exists, if not error eout of the function
     assert os.path.exists(h5_download_file), f"Input H5 file not found! {h5_download_file}"
@@ -191,6 +476,10 @@ def divide_download_process_and_delete_h5_files(h5_download_file, work_dir, runN
     if not os.path.exists(save_dir):
         os.mkdir(save_dir)
 
+    parquet_dir = os.path.join(save_dir, PARQUET_DIR)
+    if output_format == 'parquet' and not append and os.path.exists(parquet_dir):
+        shutil.rmtree(parquet_dir)
+
     # split the h5 file with a massive amount of files into individual files (.download extension)
     divided_h5_download_files = divide_download_file(h5_download_file, save_dir)
 
@@ -201,6 +490,7 @@ def divide_download_process_and_delete_h5_files(h5_download_file, work_dir, runN
 
     #loop through each input text file with url to wget
     for file in divided_h5_download_files:
+        outputs = []
         try:
             print(f'<----Processing file {i}/{len(divided_h5_download_files)}:\t{file}---->')
 
@@ -218,20 +508,23 @@ def divide_download_process_and_delete_h5_files(h5_download_file, work_dir, runN
                 token=token
             )
             # Process the H5 file
-            readH5Files(downloaded_file_tracker, save_dir)
+            outputs = readH5Files(downloaded_file_tracker, save_dir, output_format=output_format, aoi=aoi)
 
         except Exception as err:
             print(err)
         finally:
-            # Verify that a .csv file was produced
-            expected_output_file = os.path.join(save_dir,
-                                                os.path.basename(file).split('.')[
-                                                    0] + '.csv')
-
-            if os.path.exists(expected_output_file) == True:
+            # Verify that a .csv file (or parquet files of the granule) was produced
+            granule = os.path.basename(file).split('.')[0]
+            if output_format == 'parquet':
+                expected_output_file = os.path.join(parquet_dir, f'**/{granule}-*.parquet')
+            else:
+                expected_output_file = os.path.join(save_dir, granule + '.csv')
+            output_exists = len(outputs) > 0
+
+            if output_exists:
                 print(f'Expected output file exists: {expected_output_file}')
                 files_successfully_processed.append(file)
-            elif os.path.exists(expected_output_file) != True:
+            else:
                 print(
                     f'ERROR expected output file not found: {expected_output_file}')
                 files_not_processed.append(file)
@@ -1,3 +1,5 @@
 from .gee_download_files import download_files
 from .gee_export_landsat_ndvi import export_landsat_ndvi
 from .gee_export_modis_tc import export_modis_tc
+from .gee_export import DATASETS, export_dataset
+from .gee_export_scheduler import ExportScheduler
@@ -1,39 +1,119 @@
 import json
+import re
+import subprocess
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
 
 from vegmapper import pathurl
-from vegmapper.pathurl import PathURL
+from vegmapper.pathurl import PathURL, list_sizes
 
 # TO DO:
-#   1. Handle cloud data_dir
+#   1. Handle cloud data_dir (files are copied to cloud data_dir, but never skipped)
 
-def download_files(data_dir, tasks):
+def get_gcs_url(export_opts):
+    if 'gcsDestination' in export_opts.keys():
+        dst_key = 'gcsDestination'
+    elif 'cloudStorageDestination' in export_opts.keys():
+        dst_key = 'cloudStorageDestination'
+    else:
+        raise Exception('Only exports to Google Storage buckets (gs://) can be downloaded.')
+    gcs_bucket = export_opts[dst_key]['bucket']
+    gcs_prefix = export_opts[dst_key]['filenamePrefix']
+    return f'gs://{gcs_bucket}/{gcs_prefix}.tif'
+
+
+def get_shards(sizes, gcs_url):
+    # Large exports are split by GEE into {prefix}-0000000000-0000000000.tif, ... instead of {prefix}.tif
+    prefix = gcs_url[:-4]
+    shard_pattern = re.compile(re.escape(prefix) + r'-\d{10}-\d{10}\.tif')
+    return sorted((url, size) for url, size in sizes.items()
+                  if url == gcs_url or shard_pattern.fullmatch(url))
+
+
+def download_tile(data_dir, filename, gcs_url, shards, max_workers=4):
+    data_dir = PathURL(data_dir)
+    tif_name = gcs_url.split('/')[-1]
+    dst = data_dir / tif_name
+
+    if len(shards) == 0:
+        raise Exception(f'No exported files found for {gcs_url}')
+
+    if len(shards) == 1:
+        url, size = shards[0]
+        if dst.is_local and dst.path.exists() and dst.path.stat().st_size == size:
+            print(f'Skipping {filename} (already downloaded)')
+            return dst
+        print(f'Downloading {filename}')
+        pathurl.copy(url, dst, overwrite=True)
+        return dst
+
+    # Sharded export: the shard listing used for the mosaic is saved next to it
+    # so the tile is skipped as long as the exported shards do not change
+    shard_list = dict(shards)
+    shard_json = Path(f'{dst}.shards.json') if dst.is_local else None
+    if shard_json is not None and dst.path.exists() and shard_json.exists():
+        with open(shard_json) as f:
+            if json.load(f) == shard_list:
+                print(f'Skipping {filename} (already downloaded)')
+                return dst
+
+    print(f'Downloading {filename} ({len(shards)} shards)')
+    tmp_parent = data_dir.path if data_dir.is_local else None
+    with tempfile.TemporaryDirectory(dir=tmp_parent) as tmp_dir:
+        shard_tifs = [f"{tmp_dir}/{url.split('/')[-1]}" for url, _ in shards]
+        with ThreadPoolExecutor(max_workers) as pool:
+            list(pool.map(lambda args: pathurl.copy(*args, overwrite=True),
+                          zip([url for url, _ in shards], shard_tifs)))
+
+        # Mosaic the shards through a VRT, so no full-size intermediate file is written
+        vrt = f'{tmp_dir}/{tif_name[:-4]}.vrt'
+        cmd = f'gdalbuildvrt -q {vrt} {" ".join(shard_tifs)}'
+        subprocess.check_call(cmd, shell=True)
+        cog_tif = dst.path if dst.is_local else f'{tmp_dir}/{tif_name}'
+        cmd = (f'gdal_translate -q '
+               f'-of COG '
+               f'-co COMPRESS=LZW '
+               f'-co BIGTIFF=IF_SAFER '
+               f'{vrt} {cog_tif}')
+        subprocess.check_call(cmd, shell=True)
+        if not dst.is_local:
+            pathurl.copy(cog_tif, dst, overwrite=True)
+
+    if shard_json is not None:
+        with open(shard_json, 'w') as f:
+            json.dump(shard_list, f)
+    return dst
+
+
+def download_export(data_dir, filename, export_opts, sizes=None, max_workers=4):
+    # sizes: listing of the export directory (listed here if not provided)
+    gcs_url = get_gcs_url(export_opts)
+    if sizes is None:
+        sizes = list_sizes(f'{gcs_url[:-4]}*.tif')
+    shards = get_shards(sizes, gcs_url)
+    return download_tile(data_dir, filename, gcs_url, shards, max_workers)
+
+
+def download_files(data_dir, tasks, max_workers=8):
     data_dir = PathURL(data_dir)
 
     if isinstance(tasks, list):
-        for task in tasks:
-            filename = task.config['description']
-            export_opts = task.config['fileExportOptions']
-            if 'gcsDestination' in export_opts.keys():
-                dst_key = 'gcsDestination'
-            elif 'cloudStorageDestination' in export_opts.keys():
-                dst_key = 'cloudStorageDestination'
-            gcs_bucket = export_opts[dst_key]['bucket']
-            gcs_prefix = export_opts[dst_key]['filenamePrefix']
-            gcs_url = f'gs://{gcs_bucket}/{gcs_prefix}.tif'
-            dst_dir = data_dir
-            print(f'Downloading {filename}')
-            pathurl.copy(gcs_url, dst_dir)
+        exports = {task.config['description']: task.config['fileExportOptions'] for task in tasks}
     else:
         with open(tasks) as f:
-            export_dst = json.load(f)
-        for filename, export_opts in export_dst.items():
-            if 'gcsDestination' in export_opts.keys():
-                dst_key = 'gcsDestination'
-            elif 'cloudStorageDestination' in export_opts.keys():
-                dst_key = 'cloudStorageDestination'
-            gcs_bucket = export_opts[dst_key]['bucket']
-            gcs_prefix = export_opts[dst_key]['filenamePrefix']
-            gcs_url = f'gs://{gcs_bucket}/{gcs_prefix}.tif'
-            dst_dir = data_dir
-            print(f'Downloading {filename}')
-            pathurl.copy(gcs_url, dst_dir, overwrite=True)
+            exports = json.load(f)
+
+    # List each export directory once
+    sizes = {}
+    for gcs_dir in sorted({get_gcs_url(opts).rsplit('/', 1)[0] for opts in exports.values()}):
+        sizes.update(list_sizes(f'{gcs_dir}/*.tif'))
+
+    # Download tiles in parallel, and the shards of each tile in parallel
+    with ThreadPoolExecutor(max_workers) as pool:
+        futures = {filename: pool.submit(download_export, data_dir, filename, export_opts, sizes=sizes)
+                   for filename, export_opts in exports.items()}
+    failed = [filename for filename, future in futures.items() if future.exception() is not None]
+    for filename in failed:
+        print(f'Failed to download {filename}: {futures[filename].exception()}')
+    print(f'Downloaded {len(futures) - len(failed)}/{len(futures)} tiles to {data_dir}')
@@ -0,0 +1,191 @@
+#!/usr/bin/env python
+
+import json
+from functools import partial
+from pathlib import Path
+
+import ee
+import geopandas as gpd
+
+from vegmapper import pathurl
+from vegmapper.pathurl import ProjDir
+from .gee_download_files import download_export
+from .gee_export_scheduler import ExportScheduler
+
+
+# Function to mask clouds based on the pixel_qa band of Landsat 8 SR data.
+# @param {ee.Image} image input Landsat 8 SR image
+# @return {ee.Image} cloudmasked Landsat 8 image
+def maskL8sr(image):
+    # Bits 3 and 5 are cloud shadow and cloud, respectively.
+    cloudShadowBitMask = (1 << 3)
+    cloudsBitMask = (1 << 5)
+    # Get the pixel QA band.
+    qa = image.select('pixel_qa')
+    # Both flags should be set to zero, indicating clear conditions.
+    mask = qa.bitwiseAnd(cloudShadowBitMask).eq(0).And(qa.bitwiseAnd(cloudsBitMask).eq(0))
+    return image.updateMask(mask)
+
+
+# Function to add NDVI band
+def addNDVI(image):
+    ndvi = image.normalizedDifference(['B5', 'B4']).rename('NDVI')
+    return image.addBands(ndvi)
+
+
+# Function to mask clouds based on the QA60 band of Sentinel-2 data.
+def maskS2(image):
+    # Bits 10 and 11 are opaque and cirrus clouds, respectively.
+    qa = image.select('QA60')
+    mask = qa.bitwiseAnd(1 << 10).eq(0).And(qa.bitwiseAnd(1 << 11).eq(0))
+    return image.updateMask(mask)
+
+
+def landsat_ndvi(year):
+    # Cloud-masked SR median
+    sr = ee.ImageCollection('LANDSAT/LC08/C02/T1_L2').filterDate(f'{year}-01-01', f'{year}-12-31').map(maskL8sr).median()
+    return addNDVI(sr).select('NDVI')
+
+
+def modis_tc(year):
+    return ee.ImageCollection('MODIS/006/MOD44B').filterDate(f'{year}-01-01', f'{year}-12-31').select('Percent_Tree_Cover').first()
+
+
+def s2_ndvi(year):
+    sr = ee.ImageCollection('COPERNICUS/S2_SR_HARMONIZED').filterDate(f'{year}-01-01', f'{year}-12-31').map(maskS2).median()
+    return sr.normalizedDifference(['B8', 'B4']).rename('NDVI')
+
+
+# Datasets that can be exported with export_dataset. To add a new product, add an entry with:
+#   image:       function returning the ee.Image of a year (built once and used for all tiles)
+#   subdir:      subdirectory of proj_dir where the tiles are saved (proj_dir/subdir/year)
+#   native_grid: if True, the image is set to its native grid (pixel center coordinates are multiples
+#                of res) and bilinear interpolation is used when exported
+DATASETS = {
+    'landsat_ndvi': {
+        'image': landsat_ndvi,
+        'subdir': 'landsat',
+        'native_grid': True,
+    },
+    'modis_tc': {
+        'image': modis_tc,
+        'subdir': 'modis',
+        'native_grid': False,
+    },
+    's2_ndvi': {
+        'image': s2_ndvi,
+        'subdir': 'sentinel2',
+        'native_grid': False,
+    },
+}
+
+
+def export_dataset(proj_dir, sitename, tiles, res, year, dataset, gs=None, max_running=None, download=False,
+                   poll_interval=30, max_retries=2):
+    spec = DATASETS[dataset]
+    print(f'\nSubmitting GEE jobs for exporting {dataset} ...')
+
+    gdf_tiles = gpd.read_file(tiles)
+    epsg = gdf_tiles.crs.to_epsg()
+    t_xmin, _, _, t_ymax = gdf_tiles.total_bounds
+
+    ee.Initialize()
+
+    # The image graph is built once and used for all tiles
+    image = spec['image'](year)
+    native_image = None
+    if spec['native_grid']:
+        # Native crsTransform of the data (pixel center coordinates are multiples of res).
+        # It is the same grid for all tiles if the tile corners are on the grid.
+        ct_0 = [res, 0, t_xmin-res/2, 0, -res, t_ymax+res/2]
+        native_image = image.reproject(**{'crs': f'EPSG:{epsg}', 'crsTransform': ct_0}).resample('bilinear')
+
+    if gs is not None:
+        gs = pathurl.PathURL(gs)
+        if gs.storage != 'gs':
+            raise Exception('Currently GEE only supports exporting data to Google Storage buckets (gs://).')
+
+    proj_dir = ProjDir(proj_dir)
+    dst_dir = proj_dir / spec['subdir'] / f'{year}'
+
+    # With max_running, tasks are run by a scheduler keeping at most max_running tasks in flight
+    # and downloading each tile to dst_dir as soon as its task completes (if download is True).
+    scheduler = None
+    if max_running is not None:
+        scheduler = ExportScheduler(
+            export_dst_json=f'{dst_dir}/export_dst.json',
+            max_running=max_running,
+            poll_interval=poll_interval,
+            max_retries=max_retries,
+            on_complete=partial(download_export, dst_dir) if download and gs is not None else None
+        )
+
+    # Export data for each tile
+    task_list = []
+    for i in gdf_tiles.index:
+        h = gdf_tiles['h'][i]
+        v = gdf_tiles['v'][i]
+        m = gdf_tiles['mask'][i]
+        g = gdf_tiles['geometry'][i]
+        xmin = g.bounds[0]
+        ymin = g.bounds[1]
+        xmax = g.bounds[2]
+        ymax = g.bounds[3]
+        xdim = int((xmax - xmin) / res)
+        ydim = int((ymax - ymin) / res)
+
+        if m != 1:
+            print(f'#{i+1}: h{h}v{v} skipped')
+            continue
+
+        # Preferred crsTransform (pixel corner coordinates are multiples of res)
+        ct_1 = [res, 0, xmin, 0, -res, ymax]
+
+        tile_image = image
+        if native_image is not None:
+            if (xmin - t_xmin) % res == 0 and (t_ymax - ymax) % res == 0:
+                tile_image = native_image
+            else:
+                ct_0 = [res, 0, xmin-res/2, 0, -res, ymax+res/2]
+                tile_image = image.reproject(**{'crs': f'EPSG:{epsg}', 'crsTransform': ct_0}).resample('bilinear')
+
+        description = f'{dataset}_{sitename}_{year}_h{h}v{v}'
+        export_args = {
+            'image': tile_image,
+            'description': description,
+            'dimensions': f'{xdim}x{ydim}',
+            'maxPixels': 1e9,
+            'crs': f'EPSG:{epsg}',
+            'crsTransform': ct_1,
+        }
+        if gs is not None:
+            # Export data to Google Storage bucket
+            make_task = partial(ee.batch.Export.image.toCloudStorage,
+                                bucket=gs.bucket, fileNamePrefix=f'{gs.prefix}/{description}', **export_args)
+        else:
+            make_task = partial(ee.batch.Export.image.toDrive, **export_args)
+
+        if scheduler is not None:
+            scheduler.add(description, make_task)
+            print(f'#{i+1}: h{h}v{v} scheduled')
+            continue
+        task = make_task()
+        task.start()
+        task_list.append(task)
+
+        print(f'#{i+1}: h{h}v{v} started')
+
+    if scheduler is not None:
+        # Export destinations are saved by the scheduler
+        return scheduler.run()
+
+    # Save export destinations
+    export_dst = {task.config['description']: task.config['fileExportOptions'] for task in task_list}
+    if dst_dir.is_local:
+        export_dst_json = Path(f'{dst_dir}/export_dst.json')
+        if not export_dst_json.parent.exists():
+            export_dst_json.parent.mkdir(parents=True)
+        with open(export_dst_json, 'w') as f:
+            json.dump(export_dst, f)
+
+    return task_list
@@ -1,87 +1,14 @@
 #!/usr/bin/env python
 
 import argparse
-import json
-from pathlib import Path
 
-import ee
-import geopandas as gpd
+from .gee_export import export_dataset
 
-from vegmapper import pathurl
-from vegmapper.pathurl import ProjDir
 
-
-def export_modis_tc(proj_dir, sitename, tiles, res, year, gs=None):
-    print(f'\nSubmitting GEE jobs for exporting MODIS tree cover ...')
-
-    gdf_tiles = gpd.read_file(tiles)
-    epsg = gdf_tiles.crs.to_epsg()
-
-    ee.Initialize()
-
-    modisTreeCover = ee.ImageCollection('MODIS/006/MOD44B').filterDate(f'{year}-01-01', f'{year}-12-31').select('Percent_Tree_Cover').first()
-
-    # Export data for each tile
-    task_list = []
-    for i in gdf_tiles.index:
-        h = gdf_tiles['h'][i]
-        v = gdf_tiles['v'][i]
-        m = gdf_tiles['mask'][i]
-        g = gdf_tiles['geometry'][i]
-        xmin = g.bounds[0]
-        ymin = g.bounds[1]
-        xmax = g.bounds[2]
-        ymax = g.bounds[3]
-        xdim = int((xmax - xmin) / res)
-        ydim = int((ymax - ymin) / res)
-
-        # Preferred crsTransform (pixel corner coordinates are multiples of res)
-        ct = [res, 0, xmin, 0, -res, ymax]
-
-        if m == 1:
-            if gs is not None:
-                gs = pathurl.PathURL(gs)
-                if gs.storage != 'gs':
-                    raise Exception('Currently GEE only supports exporting data to Google Storage buckets (gs://).')
-                # Export data to Google Storage bucket
-                task = ee.batch.Export.image.toCloudStorage(
-                    bucket=gs.bucket,
-                    fileNamePrefix=f'{gs.prefix}/modis_tc_{sitename}_{year}_h{h}v{v}',
-                    image=modisTreeCover,
-                    description=f'modis_tc_{sitename}_{year}_h{h}v{v}',
-                    dimensions=f'{xdim}x{ydim}',
-                    maxPixels=1e9,
-                    crs=f'EPSG:{epsg}',
-                    crsTransform=ct
-                )
-            else:
-                task = ee.batch.Export.image.toDrive(
-                    image=modisTreeCover,
-                    description=f'modis_tc_{sitename}_{year}_h{h}v{v}',
-                    dimensions=f'{xdim}x{ydim}',
-                    maxPixels=1e9,
-                    crs=f'EPSG:{epsg}',
-                    crsTransform=ct
-                )
-            task.start()
-            task_list.append(task)
-
-            print(f'#{i+1}: h{h}v{v} started')
-        else:
-            print(f'#{i+1}: h{h}v{v} skipped')
-
-    # Save export destinations
-    proj_dir = ProjDir(proj_dir)
-    dst_dir = proj_dir / 'modis' / f'{year}'
-    export_dst = {task.config['description']: task.config['fileExportOptions'] for task in task_list}
-    if dst_dir.is_local:
-        export_dst_json = Path(f'{dst_dir}/export_dst.json')
-        if not export_dst_json.parent.exists():
-            export_dst_json.parent.mkdir(parents=True)
-        with open(export_dst_json, 'w') as f:
-            json.dump(export_dst, f)
-
-    return task_list
+def export_modis_tc(proj_dir, sitename, tiles, res, year, gs=None, max_running=None, download=False,
+                    poll_interval=30, max_retries=2):
+    return export_dataset(proj_dir, sitename, tiles, res, year, 'modis_tc', gs=gs, max_running=max_running,
+                          download=download, poll_interval=poll_interval, max_retries=max_retries)
 
 
 def main():
@@ -0,0 +1,168 @@
+import json
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, wait
+from pathlib import Path
+
+import ee
+
+from vegmapper import pathurl
+from vegmapper.pathurl import PathURL
+
+# GEE task states
+ACTIVE_STATES = ['UNSUBMITTED', 'READY', 'RUNNING', 'CANCEL_REQUESTED']
+FAILED_STATES = ['FAILED', 'CANCELLED']
+
+
+class ExportScheduler(object):
+    """
+    Run GEE export tasks with a limited number of tasks in flight.
+
+    Tasks are added as factories (callables returning a new, unstarted
+    ee.batch.Task) so that failed tasks can be resubmitted. The status of all
+    running tasks is polled with a single ee.data.getTaskList() call, and
+    on_complete(description, export_opts) is run in a thread pool as soon as a
+    task completes (e.g. to download the exported tile).
+
+    The export destinations and the state of the tasks are saved to
+    export_dst_json (the export_dst.json read by download_files, local or
+    cloud URL), so a scheduler created again with the same file skips the
+    completed tasks, keeps polling the tasks still running on GEE and does not
+    resubmit tasks that failed more than max_retries times.
+    """
+    def __init__(self, export_dst_json=None, max_running=10, poll_interval=30,
+                 max_retries=2, on_complete=None, max_downloads=4):
+        self.export_dst_json = PathURL(export_dst_json) if export_dst_json is not None else None
+        self.max_running = max_running
+        self.poll_interval = poll_interval
+        self.max_retries = max_retries
+        self.on_complete = on_complete
+        self.max_downloads = max_downloads
+
+        self.export_dst = {}
+        if self.export_dst_json is not None and self.export_dst_json.exists():
+            with tempfile.TemporaryDirectory() as tmp_dir:
+                local_json = self.export_dst_json.path
+                if not self.export_dst_json.is_local:
+                    local_json = Path(tmp_dir) / 'export_dst.json'
+                    pathurl.copy(self.export_dst_json, local_json, overwrite=True)
+                with open(local_json) as f:
+                    self.export_dst = json.load(f)
+
+        self.tasks = {}
+        self.factories = {}
+        self.pending = []
+        self.running = []
+        self.completed = []
+        self.failed = []
+        self.lock = threading.Lock()
+
+    def add(self, description, make_task):
+        self.factories[description] = make_task
+        entry = self.export_dst.get(description, {})
+        state = entry.get('state')
+        if state == 'COMPLETED':
+            self.completed.append(description)
+        elif state in ACTIVE_STATES and entry.get('id'):
+            # Submitted by a previous run and still running on GEE
+            self.running.append(description)
+        elif state in FAILED_STATES and entry.get('attempts', 0) > self.max_retries:
+            # Retries exhausted by previous runs
+            self.failed.append(description)
+        else:
+            self.pending.append(description)
+
+    def save(self):
+        if self.export_dst_json is None:
+            return
+        with self.lock, tempfile.TemporaryDirectory() as tmp_dir:
+            if self.export_dst_json.is_local:
+                if not self.export_dst_json.parent.exists():
+                    self.export_dst_json.parent.mkdir(parents=True)
+                tmp_json = self.export_dst_json.path.with_suffix('.tmp')
+            else:
+                tmp_json = Path(tmp_dir) / 'export_dst.json'
+            with open(tmp_json, 'w') as f:
+                json.dump(self.export_dst, f)
+            if self.export_dst_json.is_local:
+                tmp_json.replace(self.export_dst_json.path)
+            else:
+                pathurl.copy(tmp_json, self.export_dst_json, overwrite=True)
+
+    def start(self, description):
+        task = self.factories[description]()
+        task.start()
+        self.tasks[description] = task
+        entry = self.export_dst.get(description, {})
+        attempts = entry.get('attempts', 0) + 1
+        entry = dict(task.config['fileExportOptions'])
+        entry.update({'id': task.id, 'state': 'READY', 'attempts': attempts})
+        with self.lock:
+            self.export_dst[description] = entry
+        self.running.append(description)
+        print(f'{description} started (attempt {attempts})')
+
+    def poll(self):
+        # Single request for the status of all tasks
+        statuses = {t['id']: t for t in ee.data.getTaskList()}
+        done = []
+        for description in self.running:
+            entry = self.export_dst[description]
+            status = statuses.get(entry['id'])
+            if status is None:
+                continue
+            with self.lock:
+                entry['state'] = status['state']
+            if status['state'] == 'COMPLETED':
+                print(f'{description} completed')
+                done.append(description)
+                self.completed.append(description)
+            elif status['state'] in FAILED_STATES:
+                print(f"{description} {status['state'].lower()}: {status.get('error_message', '')}")
+                done.append(description)
+                if entry['attempts'] <= self.max_retries:
+                    self.pending.append(description)
+                else:
+                    self.failed.append(description)
+        self.running = [d for d in self.running if d not in done]
+        return [d for d in done if d in self.completed]
+
+    def download(self, description):
+        entry = self.export_dst[description]
+        export_opts = {k: v for k, v in entry.items() if k not in ['id', 'state', 'attempts', 'downloaded']}
+        self.on_complete(description, export_opts)
+        with self.lock:
+            entry['downloaded'] = True
+        self.save()
+
+    def run(self):
+        downloads = []
+        with ThreadPoolExecutor(self.max_downloads) as pool:
+            if self.on_complete is not None:
+                for description in self.completed:
+                    if not self.export_dst[description].get('downloaded'):
+                        downloads.append(pool.submit(self.download, description))
+
+            try:
+                while self.pending or self.running:
+                    while self.pending and len(self.running) < self.max_running:
+                        self.start(self.pending.pop(0))
+                    self.save()
+
+                    time.sleep(self.poll_interval)
+                    for description in self.poll():
+                        if self.on_complete is not None:
+                            downloads.append(pool.submit(self.download, description))
+                    print(f'{len(self.completed)} completed, {len(self.running)} running, '
+                          f'{len(self.pending)} pending, {len(self.failed)} failed')
+            finally:
+                # Tasks started so far are kept in export_dst_json even if the loop fails
+                self.save()
+
+            wait(downloads)
+            for future in downloads:
+                if future.exception() is not None:
+                    print(f'Download failed: {future.exception()}')
+
+        return list(self.tasks.values())
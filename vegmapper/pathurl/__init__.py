@@ -1 +1 @@
-from .pathurl import PathURL, ProjDir, copy
+from .pathurl import PathURL, ProjDir, copy, list_sizes
@@ -157,3 +157,19 @@ def copy(src: Union[str, Path, PathURL], dst: Union[str, Path, PathURL], overwri
             raise Exception(f'{dst} exists and overwrite is set to False.')
         else:
             subprocess.call(cp_cmd, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, shell=True)
+
+
+def list_sizes(url_pattern):
+    # Sizes of all objects matching url_pattern, from a single listing
+    ls_cmd = f'gsutil ls -l {url_pattern}'
+    try:
+        ls_output = subprocess.check_output(ls_cmd, stderr=subprocess.DEVNULL, shell=True).decode(sys.stdout.encoding).splitlines()
+    except subprocess.CalledProcessError:
+        # The url matched no objects
+        return {}
+    sizes = {}
+    for line in ls_output:
+        fields = line.split()
+        if len(fields) == 3 and fields[0].isdigit():
+            sizes[fields[2]] = int(fields[0])
+    return sizes
@@ -1,5 +1,5 @@
 from .postprocess import get_rtc_products, build_vrt, calc_temporal_mean, remove_edges, warp_to_tiles
 from .search import group_granules, skim_granules, search_granules
 from .hyp3 import batch_to_dict, batch_to_df, submit_rtc_jobs, download_files, copy_files
-from .opera_rtc_process import get_burstid_list, get_dt, get_burst_ts_df, load_burst_ts, xarray_tmean, tmean2tiff, run_rtc_temp_mean, compute_rvi_tiles
+from .opera_rtc_process import get_burstid_list, get_dt, get_burst_ts_df, get_burst_index, load_burst_array, load_burst_ts, xarray_tmean, tmean2tiff, run_rtc_temp_mean, compute_rvi_tiles
 from .opera_rtc_build_vrt import map_burst2tile, build_opera_vrt, get_epsg, check_tiles_exist, create_vrt_mosaic
@@ -1,9 +1,11 @@
 #!/usr/bin/env python
 
 import json
-import shutil
+import os
 import subprocess
-from copy import copy
+import tempfile
+import warnings
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 from pathlib import Path
 from typing import Union
@@ -11,38 +13,65 @@ from typing import Union
 import asf_search as asf
 import geopandas as gpd
 import pandas as pd
+import requests
 from hyp3_sdk import HyP3, Batch
+from requests.adapters import HTTPAdapter
 
 from vegmapper import pathurl
-from vegmapper.pathurl import ProjDir
-from vegmapper.asf import granule_search
+from vegmapper.pathurl import PathURL, ProjDir, list_sizes
+from vegmapper.asf import granule_metadata
 from .search import group_granules
 
+DOWNLOAD_CHUNK_SIZE = 1024 * 1024
 
-def batch_to_dict(batch):
+def batch_table(batch, gdf_results=None, cache_file=None):
+    """
+    Build a DataFrame of job information for a Batch, with one row per job (in batch order):
+    [job_id, sceneName, filename, pathNumber, frameNumber, startTime, stopTime]
+
+    gdf_results: granule_search or granule_metadata results of the granules of the batch
+                 (looked up with granule_metadata and cache_file if not provided)
+    """
+    # One to_dict() call per job
+    jobs = [job.to_dict() for job in batch]
+    df_jobs = pd.DataFrame({
+        'job_id': [job['job_id'] for job in jobs],
+        'sceneName': [job['job_parameters']['granules'][0] for job in jobs],
+        'filename': [job['files'][0]['filename'] if job.get('files') else None for job in jobs],
+    })
+
+    if gdf_results is None:
+        gdf_results = granule_metadata(df_jobs['sceneName'].unique().tolist(), cache_file)
+    df_results = pd.DataFrame(gdf_results[['sceneName', 'pathNumber', 'frameNumber', 'startTime', 'stopTime']])
+    df_results = df_results.drop_duplicates(subset='sceneName')
+
+    # Single join of the jobs with the search results
+    df_jobs = df_jobs.merge(df_results, on='sceneName', how='left', validate='many_to_one')
+    missing = df_jobs.loc[df_jobs['pathNumber'].isna(), 'sceneName']
+    if len(missing) > 0:
+        raise Exception(f'Granules not found in search results: {", ".join(missing.unique())}')
+
+    return df_jobs
+
+
+def batch_to_dict(batch, gdf_results=None, cache_file=None):
     """
     Convert a Batch to a dictionary of job information - {(path, frame): Batch}.
     """
-    granule_list = [job.to_dict()['job_parameters']['granules'][0] for job in batch]
-    gdf_results = granule_search(granule_list).set_index('sceneName')
+    jobs = list(batch)
+    df_jobs = batch_table(batch, gdf_results, cache_file)
 
     batch_dict = {}
-    for granule, job in zip(granule_list, batch):
-        p = gdf_results.loc[granule, 'pathNumber']
-        f = gdf_results.loc[granule, 'frameNumber']
-        if (p, f) not in batch_dict:
-            batch_dict[(p, f)] = {
-                'batch': Batch([job]),
-                'granules': [granule]
-            }
-        else:
-            batch_dict[(p, f)]['batch'] += Batch([job])
-            batch_dict[(p, f)]['granules'].append(granule)
+    for (p, f), indices in df_jobs.groupby(['pathNumber', 'frameNumber'], sort=False).indices.items():
+        batch_dict[(p, f)] = {
+            'batch': Batch([jobs[i] for i in indices]),
+            'granules': df_jobs['sceneName'].iloc[indices].to_list()
+        }
 
     return batch_dict
 
 
-def batch_to_df(batch: Batch):
+def batch_to_df(batch: Batch, gdf_results=None, cache_file=None):
     """
     Convert a Batch to a DataFrame of product information.
     [filename, job_id, sceneName, pathNumber, frameNumber, startTime, stopTime]
@@ -50,37 +79,49 @@ def batch_to_df(batch: Batch):
     if not batch.complete():
         raise Exception(f'Batch is not complete. Wait for it to be completed and try again.')
 
-    granule_list = [job.to_dict()['job_parameters']['granules'][0] for job in batch]
-    gdf_results = granule_search(granule_list).set_index('sceneName')
-
-    df_products = pd.DataFrame()
-    for granule, job in zip(granule_list, batch):
-        df = pd.DataFrame(
-            {
-                'filename': [job.to_dict()['files'][0]['filename']],
-                'job_id': [job.to_dict()['job_id']],
-                'sceneName': [granule],
-                'pathNumber': [gdf_results.loc[granule, 'pathNumber']],
-                'frameNumber': [gdf_results.loc[granule, 'frameNumber']],
-                'startTime': [gdf_results.loc[granule, 'startTime']],
-                'stopTime': [gdf_results.loc[granule, 'stopTime']],
-            }
-        )
-        df_products = pd.concat([df_products, df])
-
-    df_products.sort_values(by=['pathNumber', 'frameNumber', 'startTime']).reset_index(drop=True)
+    df_products = batch_table(batch, gdf_results, cache_file)
+    df_products = df_products[['filename', 'job_id', 'sceneName', 'pathNumber', 'frameNumber', 'startTime', 'stopTime']]
+    df_products = df_products.sort_values(by=['pathNumber', 'frameNumber', 'startTime']).reset_index(drop=True)
 
     return df_products
 
 
+def normalize_parameter(value):
+    # Integral numbers as ints (e.g. resolution=30.0 and resolution=30 are the same job)
+    if isinstance(value, dict):
+        return {k: normalize_parameter(v) for k, v in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [normalize_parameter(v) for v in value]
+    if isinstance(value, float) and value.is_integer():
+        return int(value)
+    return value
+
+
+def job_key(job_parameters):
+    """
+    Hashable key of job parameters, used to look up previously submitted jobs in a set.
+    Parameter values are normalized first, so the same job gets the same key whether
+    its numbers were given as ints or floats.
+    """
+    return json.dumps(normalize_parameter(job_parameters), sort_keys=True)
+
+
 def submit_rtc_jobs(granules,
                     proj_dir,
                     hyp3=None,
                     job_name=None,
                     resubmit=False,
+                    confirm=None,
+                    chunk_size=200,
+                    max_workers=4,
                     **rtc_opts):
     """
     Submit RTC jobs for granules in search results (geojson or GeoDataFrame).
+
+    Jobs are prepared locally and submitted with hyp3.submit_prepared_jobs in chunks of
+    chunk_size jobs (submitted concurrently by max_workers threads). By default the user is
+    prompted for confirmation; set confirm to True to submit without prompting, or to False
+    to only report the jobs that would be submitted.
     """
     # Sentinel-1 directory
     proj_dir = ProjDir(proj_dir)
@@ -99,17 +140,17 @@ def submit_rtc_jobs(granules,
 
     # Get submitted and not expired jobs on HyP3 server
     batch = hyp3.find_jobs().filter_jobs(include_expired=False)
-    jobs_on_hyp3 = {job.to_dict()['job_id']: job.to_dict()['job_parameters'] for job in batch}
+    jobs_on_hyp3 = {job_key(job.to_dict()['job_parameters']) for job in batch}
 
     # Load rtc_jobs.json on s1_dir
     rtc_jobs_file = s1_dir / 'rtc_jobs.json'
     if rtc_jobs_file.exists():
         pathurl.copy(s1_dir / 'rtc_jobs.json', '.', overwrite=True)
         with open('rtc_jobs.json') as f:
-            jobs_on_proj_dir = json.load(f)
+            jobs_on_proj_dir = {job_key(job_parameters) for job_parameters in json.load(f).values()}
         Path('rtc_jobs.json').unlink()
     else:
-        jobs_on_proj_dir = {}
+        jobs_on_proj_dir = set()
 
     num_granules_requested = gdf_frames.num_granules.sum()
     print(f'\n{num_granules_requested} granules requested for RTC processing:')
@@ -119,17 +160,16 @@ def submit_rtc_jobs(granules,
     if not resubmit:
         for i, row in gdf_frames.iterrows():
             granules_requested = row['granules'].split(',')
-            granules_to_be_submitted = copy(granules_requested)
+            granules_to_be_submitted = []
             for granule in granules_requested:
-                job_parameters = {'granules': [granule], **rtc_opts}
-                if job_parameters in jobs_on_hyp3.values():
-                    granules_to_be_submitted.remove(granule)
+                key = job_key({'granules': [granule], **rtc_opts})
+                if key in jobs_on_hyp3:
                     print(f'Skipping {granule} - it was previously submitted for RTC processing and is still available on HyP3 server.')
                     continue
-                if job_parameters in jobs_on_proj_dir.values():
-                    granules_to_be_submitted.remove(granule)
+                if key in jobs_on_proj_dir:
                     print(f'Skipping {granule} - it was previously submitted for RTC processing and could still be available under project directory. To re-submit these ganules, quit below and re-run with the "resubmit" switch set to True.')
                     continue
+                granules_to_be_submitted.append(granule)
             gdf_frames.loc[i, 'granules'] = ','.join(granules_to_be_submitted)
             gdf_frames.loc[i, 'num_granules'] = len(granules_to_be_submitted)
 
@@ -144,96 +184,229 @@ def submit_rtc_jobs(granules,
     else:
         print(f'\n{num_granules_to_be_submitted} granules requested for RTC processing, but the remaining quota only has {quota} jobs left. If proceed below, only the first {quota} granules will be submitted.')
 
-    user_input = input('\nEnter "yes" to confirm and proceed to submit the granules for RTC processing. Enter other keys to quit.')
-    if user_input.lower() != 'yes':
+    if confirm is None:
+        user_input = input('\nEnter "yes" to confirm and proceed to submit the granules for RTC processing. Enter other keys to quit.')
+        confirm = user_input.lower() == 'yes'
+    if not confirm:
         print('\nNo jobs submitted.')
         return
 
     if job_name is None:
         job_name = datetime.now().strftime('%Y%m%dT%H%M%S')
 
+    granules_to_be_submitted = [granule for granules in gdf_frames['granules'] for granule in granules.split(',') if granule]
+    if quota is not None and quota < len(granules_to_be_submitted):
+        granules_to_be_submitted = granules_to_be_submitted[:int(quota)]
+
+    # Submit prepared jobs in chunks, one request per chunk
+    prepared_jobs = [hyp3.prepare_rtc_job(granule, job_name, **rtc_opts) for granule in granules_to_be_submitted]
+    chunks = [prepared_jobs[i:i+chunk_size] for i in range(0, len(prepared_jobs), chunk_size)]
+    with ThreadPoolExecutor(max_workers) as pool:
+        futures = [pool.submit(hyp3.submit_prepared_jobs, chunk) for chunk in chunks]
+
     batch = Batch()
-    for _, row in gdf_frames.iterrows():
-        for granule in row['granules'].split(','):
-            batch += hyp3.submit_rtc_job(granule, job_name, **rtc_opts)
-    print(f'\nJob {job_name} submitted.')
+    for chunk, future in zip(chunks, futures):
+        if future.exception() is not None:
+            print(f'Failed to submit {len(chunk)} jobs: {future.exception()}')
+        else:
+            batch += future.result()
+    print(f'\nJob {job_name} submitted ({len(batch)}/{len(prepared_jobs)} jobs).')
 
     return batch, job_name
 
 
-def download_batch(batch, dst_dir, quiet=True):
-    for job in batch:
-        files = job.files
-        for file in files:
-            url = file['url']
-            cmd = f'wget '
-            if quiet:
-                cmd = cmd + '-q '
-            cmd = cmd + f'-c -P {dst_dir} {url}'
-            subprocess.call(cmd, shell=True)
+def hyp3_session(pool_size=8):
+    # Session with a connection pool shared by the download workers
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=3)
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    return session
 
 
-def download_files(batch, proj_dir: Union[str, Path, ProjDir], wget=True, quiet=True):
+def download_product(session, file, dst, dst_size=None, quiet=True):
     """
-    Download files for a batch and sort them into corresponding path_frame folders in dst directory.
-    """
-    # Convert proj_dir to a ProjDir object
-    proj_dir = ProjDir(proj_dir)
+    Download a product file ({'url', 'filename', 'size'} of job.files) to dst (local path or cloud URL).
 
-    # Download directly to proj_dir if it's local
-    s1_dir = proj_dir / 'Sentinel-1'
-    if s1_dir.is_local:
-        download_dir = s1_dir
+    Local downloads are written to a .part file first and resumed with a range request if interrupted.
+    Cloud downloads are streamed to the destination with gsutil. The downloaded size is checked against
+    the size reported by HyP3, and the file is skipped if dst already has that size (dst_size for cloud dst).
+    """
+    url = file['url']
+    size = file['size']
+    dst = PathURL(dst)
+
+    if dst.is_local:
+        if dst.path.exists() and dst.path.stat().st_size == size:
+            if not quiet:
+                print(f"Skipping {file['filename']} (already downloaded)")
+            return dst
+        part = Path(f'{dst}.part')
+        offset = part.stat().st_size if part.exists() else 0
+        if offset > size:
+            offset = 0
+        if offset < size:
+            headers = {'Range': f'bytes={offset}-'} if offset > 0 else {}
+            with session.get(url, stream=True, headers=headers, timeout=60) as response:
+                response.raise_for_status()
+                if response.status_code != 206:
+                    # The server sent the whole file
+                    offset = 0
+                with open(part, 'ab' if offset > 0 else 'wb') as f:
+                    for chunk in response.iter_content(DOWNLOAD_CHUNK_SIZE):
+                        f.write(chunk)
+        downloaded_size = part.stat().st_size
+        if downloaded_size != size:
+            part.unlink()
+            raise Exception(f"{file['filename']}: downloaded {downloaded_size} bytes, expected {size} bytes")
+        os.replace(part, dst.path)
     else:
-        download_dir = Path('hyp3_downloads')
+        if dst_size == size:
+            if not quiet:
+                print(f"Skipping {file['filename']} (already downloaded)")
+            return dst
+        downloaded_size = 0
+        with session.get(url, stream=True, timeout=60) as response:
+            response.raise_for_status()
+            proc = subprocess.Popen(f'gsutil -q cp - {dst}', stdin=subprocess.PIPE, shell=True)
+            try:
+                for chunk in response.iter_content(DOWNLOAD_CHUNK_SIZE):
+                    proc.stdin.write(chunk)
+                    downloaded_size += len(chunk)
+            finally:
+                proc.stdin.close()
+                returncode = proc.wait()
+        if returncode != 0:
+            raise Exception(f"{file['filename']}: failed to upload to {dst}")
+        if downloaded_size != size:
+            subprocess.call(f'gsutil -q rm {dst}', stderr=subprocess.DEVNULL, shell=True)
+            raise Exception(f"{file['filename']}: downloaded {downloaded_size} bytes, expected {size} bytes")
+
+    if not quiet:
+        print(f"Downloaded {file['filename']}")
+    return dst
+
+
+def update_file(dst, write):
+    """
+    Replace dst (local path or cloud URL) with a file written by write(tmp_file), so dst is never partially written.
+    """
+    dst = PathURL(dst)
+    if dst.is_local:
+        tmp_file = Path(f'{dst}.tmp')
+        write(tmp_file)
+        os.replace(tmp_file, dst.path)
+    else:
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            tmp_file = Path(tmp_dir) / dst.path.split('/')[-1]
+            write(tmp_file)
+            pathurl.copy(tmp_file, dst, overwrite=True)
 
-    # Download files
-    batch_dict = batch_to_dict(batch)
-    for (p, f), d in batch_dict.items():
-        dst_dir = download_dir / f'{p}_{f}'
-        if not dst_dir.exists():
-            dst_dir.path.mkdir(parents=True)
-        print(f'Downloading files of (Path {p}, Frame {f}) to {dst_dir}:')
-        if wget:
-            download_batch(d['batch'], dst_dir, quiet)
+
+def update_rtc_records(s1_dir, batch, gdf_results=None):
+    """
+    Add the jobs of a batch to rtc_jobs.json and rtc_products.csv in s1_dir.
+    """
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        # Load rtc_jobs.json in s1_dir if any
+        rtc_jobs_file = s1_dir / 'rtc_jobs.json'
+        if rtc_jobs_file.exists():
+            pathurl.copy(rtc_jobs_file, f'{tmp_dir}/rtc_jobs.json', overwrite=True)
+            with open(f'{tmp_dir}/rtc_jobs.json') as f:
+                dict_jobs = json.load(f)
         else:
-            d['batch'].download_files(f'{dst_dir}')
+            dict_jobs = {}
 
-    # Load rtc_jobs.json in dst if any
-    rtc_jobs_file = Path(f'{download_dir}/rtc_jobs.json')
-    if rtc_jobs_file.exists():
-        with open(rtc_jobs_file) as f:
-            dict_jobs = json.load(f)
-    else:
-        dict_jobs = {}
+        # Read rtc_products.csv in s1_dir if any
+        rtc_products_file = s1_dir / 'rtc_products.csv'
+        if rtc_products_file.exists():
+            pathurl.copy(rtc_products_file, f'{tmp_dir}/rtc_products.csv', overwrite=True)
+            df_products = pd.read_csv(f'{tmp_dir}/rtc_products.csv', parse_dates=['startTime', 'stopTime'])
+        else:
+            df_products = pd.DataFrame()
 
     # Update rtc_jobs.json
-    for _, job in enumerate(batch):
-        job_id = job.to_dict()['job_id']
-        job_parameters = job.to_dict()['job_parameters']
-        if job_id not in dict_jobs:
-            dict_jobs[job_id] = job_parameters
-    with open(rtc_jobs_file, 'w') as f:
-        json.dump(dict_jobs, f)
-    print(f'{rtc_jobs_file} updated.')
+    for job in batch:
+        if job.job_id not in dict_jobs:
+            dict_jobs[job.job_id] = job.job_parameters
 
-    # Read rtc_products.csv in dst if any
-    rtc_products_file = Path(f'{download_dir}/rtc_products.csv')
-    if rtc_products_file.exists():
-        df_products = pd.read_csv(rtc_products_file)
-    else:
-        df_products = pd.DataFrame()
+    def write_jobs(tmp_file):
+        with open(tmp_file, 'w') as f:
+            json.dump(dict_jobs, f)
+
+    update_file(rtc_jobs_file, write_jobs)
+    print(f'{rtc_jobs_file} updated.')
 
     # Update rtc_products.csv
-    df_products = pd.concat([df_products, batch_to_df(batch)]).drop_duplicates(ignore_index=True)
-    df_products.sort_values(by=['pathNumber', 'frameNumber', 'startTime']).to_csv(rtc_products_file, index=False)
+    df_products = pd.concat([df_products, batch_to_df(batch, gdf_results)]).drop_duplicates(ignore_index=True)
+    df_products = df_products.sort_values(by=['pathNumber', 'frameNumber', 'startTime'])
+    update_file(rtc_products_file, lambda tmp_file: df_products.to_csv(tmp_file, index=False))
     print(f'{rtc_products_file} updated.')
 
 
+def download_files(batch, proj_dir: Union[str, Path, ProjDir], wget=None, quiet=True, max_workers=8):
+    """
+    Download files for a batch and sort them into corresponding path_frame folders in the Sentinel-1
+    directory of proj_dir, then update rtc_jobs.json and rtc_products.csv.
+
+    Files are downloaded concurrently by max_workers threads. For cloud projects, files are streamed
+    to the project directory without being saved locally. wget is deprecated and ignored.
+    """
+    if wget is not None:
+        warnings.warn('The wget argument of download_files is deprecated and ignored; files are '
+                      'downloaded with a shared HTTP session.', DeprecationWarning, stacklevel=2)
+
+    # Convert proj_dir to a ProjDir object
+    proj_dir = ProjDir(proj_dir)
+    s1_dir = proj_dir / 'Sentinel-1'
+
+    # Look up the granules of the batch once for both batch_to_dict and batch_to_df,
+    # searching only the granules not in the granule metadata cache of the project
+    granule_list = list({job.job_parameters['granules'][0] for job in batch})
+    gdf_results = granule_metadata(granule_list, s1_dir / 'granule_metadata.parquet')
+
+    # Sizes of files already in the cloud project directory, from a single listing
+    dst_sizes = {} if s1_dir.is_local else list_sizes(f'{s1_dir}/*/*')
+
+    # Download files
+    session = hyp3_session(max_workers)
+    futures = {}
+    with ThreadPoolExecutor(max_workers) as pool:
+        batch_dict = batch_to_dict(batch, gdf_results)
+        for (p, f), d in batch_dict.items():
+            dst_dir = s1_dir / f'{p}_{f}'
+            if dst_dir.is_local:
+                dst_dir.path.mkdir(parents=True, exist_ok=True)
+            print(f"Downloading files of (Path {p}, Frame {f}) to {dst_dir}: {len(d['batch'])} jobs")
+            for job in d['batch']:
+                for file in job.files:
+                    dst = dst_dir / file['filename']
+                    futures[file['filename']] = pool.submit(download_product, session, file, dst,
+                                                            dst_sizes.get(f'{dst}'), quiet)
+
+    failed = [filename for filename, future in futures.items() if future.exception() is not None]
+    for filename in failed:
+        print(f'Failed to download {filename}: {futures[filename].exception()}')
+    print(f'Downloaded {len(futures) - len(failed)}/{len(futures)} files to {s1_dir}')
+
+    # Update rtc_jobs.json and rtc_products.csv with the jobs of which all files were downloaded
+    failed = set(failed)
+    downloaded_jobs = [job for job in batch if not any(file['filename'] in failed for file in job.files)]
+    if len(downloaded_jobs) < len(batch):
+        print(f'{len(batch) - len(downloaded_jobs)} jobs with failed downloads are not added to rtc_jobs.json '
+              'and rtc_products.csv. Re-run download_files to resume their downloads.')
+    if downloaded_jobs:
+        update_rtc_records(s1_dir, Batch(downloaded_jobs), gdf_results)
+
+
 def copy_files(proj_dir: ProjDir, download_dir='hyp3_downloads'):
     """
     Copy downloaded files to project directory and update rtc_jobs.json and rtc_products.csv.
+
+    Deprecated: download_files saves files to the project directory and updates the records itself.
     """
+    warnings.warn('copy_files is deprecated; download_files saves files to the project directory.',
+                  DeprecationWarning, stacklevel=2)
 
     download_dir = Path(download_dir)
     s1_dir = proj_dir / 'Sentinel-1'
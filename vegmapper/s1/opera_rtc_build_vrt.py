@@ -1,12 +1,9 @@
 #!/usr/bin/env python
 
 import os
-import shutil
 import geopandas as gpd
 from osgeo import gdal
 import rasterio
-from rasterio.crs import CRS
-import tempfile
 import subprocess
 from concurrent.futures import ThreadPoolExecutor
 import warnings
@@ -75,64 +72,74 @@ def get_epsg(file_path):
         return None
         
 
-def process_row(row, polarizations, rtc_dir, out_vrt_dir, target_crs, created_files, site, start_date, end_date):
+def burst_files(row, pol, rtc_dir, start_date, end_date):
+    # Existing temporal means (from run_rtc_temp_mean) of the bursts overlapping a tile
+    files = [f"{rtc_dir}/{name}_tmean_{start_date}_{end_date}_{pol}.tif" for name in row['overlapping_bursts']]
+    return [file for file in files if os.path.exists(file)]
+
+
+def reproject_burst(file, target_crs):
+    """
+    Warp a burst temporal mean to target_crs as a VRT next to it (kept if it already exists).
+    """
+    reprojected_file = file.replace('.tif', '_reprojected.vrt')
+    if not os.path.exists(reprojected_file):
+        # Write to a temporary file in the same directory (so relative source paths stay valid)
+        # and rename it, so a half-written VRT is never used
+        temp_path = reprojected_file.replace('.vrt', '_tmp.vrt')
+        try:
+            warp_command_reproject = [
+                'gdalwarp', '-q', '-overwrite',
+                '-t_srs', target_crs,
+                '-r', 'near',
+                '-dstnodata', 'nan',
+                '-of', 'VRT',
+                file, temp_path
+            ]
+            subprocess.run(warp_command_reproject, check=True)
+            os.replace(temp_path, reprojected_file)
+        except Exception as e:
+            # Cleanup in case of error
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            raise e
+    return reprojected_file
+
+
+def process_row(row, polarizations, rtc_dir, out_vrt_dir, target_crs, reprojected, site, start_date, end_date, res=None):
+    """
+    Mosaic the reprojected bursts (reprojected maps burst files to their reprojected VRTs) into a tile.
+    """
     if row['mask'] == 0:
         return
 
-    overlapping_names = row['overlapping_bursts']
     bbox = row['geometry'].bounds  # [minx, miny, maxx, maxy]
     position_h = row['h']
     position_v = row['v']
-    target_epsg = CRS.from_string(target_crs).to_epsg()
 
     for pol in polarizations:
-        files_2_merge = [f"{rtc_dir}/{name}_tmean_{start_date}_{end_date}_{pol}.tif" for name in overlapping_names]
-        files_2_merge = [file for file in files_2_merge if os.path.exists(file)]
-        
         output_tif = f'{out_vrt_dir}/s1_tile_{site}_{start_date}_{end_date}_h{str(position_h)}_v{str(position_v)}_{pol}_pre.tif'
         output_vrt_mosaic = f'{out_vrt_dir}/s1_mosaic_{site}_{start_date}_{end_date}_h{str(position_h)}_v{str(position_v)}_{pol}.vrt'
 
-        reprojected_files = []
-        for file in files_2_merge:
-            reprojected_file = file.replace('.tif', '_reprojected.vrt')
-
-            if reprojected_file not in created_files:
-                created_files.add(reprojected_file)
-                if not os.path.exists(reprojected_file):
-                    # Use a temporary file to ensure atomic creation
-                    with tempfile.NamedTemporaryFile(delete=False, suffix='.vrt') as temp_file:
-                        temp_path = temp_file.name
-                    try:
-                        warp_command_reproject = [
-                            'gdalwarp', '-q',
-                            '-t_srs', target_crs,
-                            '-r', 'near',
-                            '-dstnodata', 'nan',
-                            '-of', 'VRT',
-                            file, temp_path
-                        ]
-                        subprocess.run(warp_command_reproject, check=True)
-                        shutil.move(temp_path, reprojected_file)
-                    except Exception as e:
-                        # Cleanup in case of error
-                        if os.path.exists(temp_path):
-                            os.remove(temp_path)
-                        raise e
-            
-            reprojected_files.append(reprojected_file)
+        reprojected_files = [reprojected[file] for file in burst_files(row, pol, rtc_dir, start_date, end_date)]
 
-        # Build VRT mosaic
-        buildvrt_command = ['gdalbuildvrt', '-q', '-srcnodata', 'nan', '-vrtnodata', 'nan', output_vrt_mosaic] + reprojected_files
+        # Build VRT mosaic (the NaN nodata of the temporal mean COGs is carried by the reprojected VRTs)
+        buildvrt_command = ['gdalbuildvrt', '-q', '-vrtnodata', 'nan', output_vrt_mosaic] + reprojected_files
         subprocess.run(buildvrt_command, check=True)
 
         # Create final GeoTIFF
+        if res is None:
+            res_options = ['-r', 'near']
+        else:
+            # Averaged from the overviews of the tmean COGs (or full resolution if there are none)
+            res_options = ['-tr', str(res), str(res), '-r', 'average']
         warp_command = [
             'gdalwarp',
             '-overwrite',
             '-t_srs', target_crs, '-et', '0',
             '-te', str(bbox[0]), str(bbox[1]), str(bbox[2]), str(bbox[3]),
-            '-srcnodata', 'nan', '-dstnodata', 'nan',
-            '-r', 'near',
+            '-dstnodata', 'nan',
+            *res_options,
             '-co', 'COMPRESS=LZW',
             '-of', 'GTiff',
             output_vrt_mosaic,
@@ -147,28 +154,42 @@ def process_row(row, polarizations, rtc_dir, out_vrt_dir, target_crs, created_fi
             '-co', 'COMPRESS=LZW',
             '-co', 'BIGTIFF=IF_SAFER',
             '-co', 'OVERVIEW_RESAMPLING=NEAREST',
+            '-a_nodata', 'nan',
             output_tif,
             output_tif.replace('_pre.tif', '.tif'),  # Modify filename for COG output
         ]
         
         subprocess.run(cog_command, check=True)
 
-def build_opera_vrt(burst2tile_gdf, rtc_dir, site, start_date, end_date):
+def build_opera_vrt(burst2tile_gdf, rtc_dir, site, start_date, end_date, res=None):
+    """
+    Mosaic the burst temporal means of run_rtc_temp_mean into the tiles of burst2tile_gdf.
+    If res is set (e.g. 60 or 120), tiles are made at res instead of the resolution of the
+    temporal means, so use a separate rtc_dir for each resolution.
+    """
     # Output directory
     out_vrt_dir = f'{rtc_dir}/tile_vrts'
     os.makedirs(out_vrt_dir, exist_ok=True)
 
     polarizations = ['VV', 'VH']
     target_crs = burst2tile_gdf.crs.to_string()
+    active_tiles = [row for _, row in burst2tile_gdf.iterrows() if row['mask'] != 0]
 
-    # Shared set for tracking created files
-    created_files = set()
-
-    # Process rows in parallel
     with ThreadPoolExecutor() as executor:
+        # Phase 1: reproject each burst once, however many tiles it overlaps.
+        # Futures are keyed by burst file, so duplicates are submitted only once.
+        futures = {}
+        for row in active_tiles:
+            for pol in polarizations:
+                for file in burst_files(row, pol, rtc_dir, start_date, end_date):
+                    if file not in futures:
+                        futures[file] = executor.submit(reproject_burst, file, target_crs)
+        reprojected = {file: future.result() for file, future in futures.items()}
+
+        # Phase 2: mosaic the tiles once all the reprojected bursts are ready
         futures = [
-            executor.submit(process_row, row, polarizations, rtc_dir, out_vrt_dir, target_crs, created_files, site, start_date, end_date)
-            for _, row in burst2tile_gdf.iterrows()
+            executor.submit(process_row, row, polarizations, rtc_dir, out_vrt_dir, target_crs, reprojected, site, start_date, end_date, res)
+            for row in active_tiles
         ]
         # Wait for all tasks to complete
         for future in futures:
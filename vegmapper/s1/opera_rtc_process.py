@@ -3,24 +3,32 @@
 import os
 import re
 import time
+import warnings
 import numpy as np
 import pandas as pd
 import geopandas as gpd
 import rasterio
+from rasterio.enums import Resampling
+from rasterio.session import AWSSession
+from rasterio.transform import Affine
 from rasterio.shutil import copy as rio_copy
 from rasterio.errors import RasterioIOError
+from rasterio.warp import transform_geom
+from rasterio.windows import Window, from_bounds, bounds as window_bounds, transform as window_transform
+from shapely.geometry import box, mapping, shape
 import xarray as xr
 from concurrent.futures import ThreadPoolExecutor, as_completed
 import backoff
 from requests.exceptions import ConnectionError, HTTPError
 from rasterio.errors import RasterioIOError
-import s3fs
 import gc
 from tqdm import tqdm
 
+from .search import OPERA_ID_REGEX
+
 
 # get all related burst
-def get_burstid_list(burst_name, granule_gdf):
+def get_burstid_list(burst_name, granule_gdf, burst_index=None):
     """
     Function to get list of available bursts 
     for the same ID. 
@@ -29,11 +37,19 @@ def get_burstid_list(burst_name, granule_gdf):
     burst_name = string.
     granule_gdf = geodataframe with RTC
         granules for a specific time and region.
+    burst_index = dictionary from get_burst_index (optional).
+        If provided, the bursts are looked up in
+        the index instead of scanning granule_gdf.
     
     returns
     -------
     burstid_list = list.
     """
+    if burst_index is not None:
+        if burst_name not in burst_index:
+            return []
+        return sorted(burst_index[burst_name]['OPERA L2-RTC-S1 ID'].tolist())
+
     burst_id_df = granule_gdf[granule_gdf['fileID'].str.startswith(burst_name)]
     burstid_list = sorted(burst_id_df['fileID'].tolist())
 
@@ -49,29 +65,86 @@ def get_dt(opera_id, date_regex):
         raise Exception(f"Acquisition timestamp not found in scene ID: {opera_id}") 
 
 
+# parse burst ID, acquisition and processing times of OPERA IDs
+def parse_opera_ids(opera_rtc_ids):
+    ids = pd.Series(opera_rtc_ids).reset_index(drop=True)
+    parsed = ids.str.extract(OPERA_ID_REGEX)
+    unmatched = parsed['acquisition_time'].isna()
+    if unmatched.any():
+        # e.g. products other than RTC-S1 bursts in the granule table
+        warnings.warn(f"Skipping {unmatched.sum()} IDs that are not OPERA RTC-S1 burst IDs, "
+                      f"e.g. {ids[unmatched].iloc[0]}")
+        ids = ids[~unmatched].reset_index(drop=True)
+        parsed = parsed[~unmatched].reset_index(drop=True)
+
+    return pd.DataFrame(data={
+        'OPERA L2-RTC-S1 ID': ids,
+        'burst_id': parsed['burst_id'],
+        'AcquisitionDateTime': pd.to_datetime(parsed['acquisition_time'], format='%Y%m%dT%H%M%SZ', utc=True),
+        'ProcessDateTime': pd.to_datetime(parsed['processing_time'], format='%Y%m%dT%H%M%SZ', utc=True)
+    })
+
+
+# keep the latest processed granule of each acquisition
+def latest_acquisitions(ids_df, subset=None):
+    if subset is None:
+        subset = ['AcquisitionDateTime']
+    return (ids_df
+            .sort_values(by='ProcessDateTime', kind='stable')
+            .drop_duplicates(subset=subset, keep='last')
+            .drop('ProcessDateTime', axis=1))
+
+
 # get burst time series dataframe 
 def get_burst_ts_df(opera_rtc_ids):
-    # date time regular expression definitions
-    acquisition_date_regex = r"(?<=_)\d{8}T\d{6}Z(?=_\d{8}T\d{6})"
-    process_dt_regex = r"(?<=\d{8}T\d{6}Z_)\d{8}T\d{6}Z(?=_S1)"
-    acquisition_dt = pd.to_datetime([get_dt(id, acquisition_date_regex) for id in opera_rtc_ids])
-    process_dt = pd.to_datetime([get_dt(id, process_dt_regex) for id in opera_rtc_ids])
-
-    times_series_df = (pd.DataFrame(data={
-        'OPERA L2-RTC-S1 ID': opera_rtc_ids, 
-        'AcquisitionDateTime': acquisition_dt,
-        'ProcessDateTime': process_dt
-    })
-    .sort_values(by='ProcessDateTime')
-    .drop_duplicates(subset=['AcquisitionDateTime'], keep='last')
-    .drop('ProcessDateTime', axis=1)
+    times_series_df = (latest_acquisitions(parse_opera_ids(opera_rtc_ids))
+    .drop('burst_id', axis=1)
     .sort_values(by='AcquisitionDateTime')
     .reset_index(drop=True))
 
     return times_series_df
 
 
-# load array using a burst timeseries dataframe
+# get time series dataframes of all bursts
+def get_burst_index(granule_gdf):
+    """
+    Build a burst index: {burst ID: burst time series dataframe}.
+    OPERA IDs are parsed once for all granules, so looking up
+    the time series of a burst does not scan granule_gdf.
+    """
+    ids_df = parse_opera_ids(granule_gdf['fileID'])
+    ids_df = (latest_acquisitions(ids_df, subset=['burst_id', 'AcquisitionDateTime'])
+              .sort_values(by=['burst_id', 'AcquisitionDateTime'])
+              .reset_index(drop=True))
+
+    # The rows of each burst are contiguous after sorting
+    bursts, starts = np.unique(ids_df.pop('burst_id').to_numpy(dtype=str), return_index=True)
+    stops = np.r_[starts[1:], len(ids_df)]
+    burst_index = {}
+    for burst, start, stop in zip(bursts, starts, stops):
+        burst_index[burst] = ids_df.iloc[start:stop].reset_index(drop=True)
+
+    return burst_index
+
+
+# GDAL configuration for reading OPERA COGs from S3
+GDAL_S3_CONFIG = {
+    'GDAL_DISABLE_READDIR_ON_OPEN': 'EMPTY_DIR',    # do not list the S3 prefix when opening a file
+    'CPL_VSIL_CURL_ALLOWED_EXTENSIONS': '.tif',
+    'GDAL_HTTP_MULTIPLEX': 'YES',                   # HTTP/2 multiplexing of range requests
+    'GDAL_HTTP_VERSION': '2',
+    'GDAL_HTTP_MERGE_CONSECUTIVE_RANGES': 'YES',
+    'GDAL_CACHEMAX': 512,                           # block cache (MB)
+    'VSI_CACHE': 'TRUE',
+    'VSI_CACHE_SIZE': 64 * 1024 * 1024,
+}
+
+
+def opera_s3_path(opera_id, polarization, event):
+    return f"/vsis3/{event['Bucket']}/OPERA_L2_RTC-S1/{opera_id}/{opera_id}_{polarization}.tif"
+
+
+# read a single image into its slot of the burst buffer, with retries
 @backoff.on_exception(
     backoff.expo,
     (ConnectionError, HTTPError, RasterioIOError),
@@ -79,78 +152,163 @@ def get_burst_ts_df(opera_rtc_ids):
     max_time=60,
     jitter=backoff.full_jitter,
 )
+def read_into(path, out, session, ref):
+    with rasterio.Env(session, **GDAL_S3_CONFIG):
+        with rasterio.open(path) as src:
+            if src.transform == ref['src_transform'] and (src.height, src.width) == ref['src_shape']:
+                # Only the blocks of the COG intersecting the window are requested
+                # (from the overviews if out is smaller than the window)
+                src.read(out=out, window=ref['window'], resampling=ref['resampling'])
+            else:
+                # Image on a different grid than the first image of the burst
+                window = from_bounds(*ref['bounds'], transform=src.transform)
+                out[:] = src.read(window=window, out_shape=out.shape, boundless=True, fill_value=np.nan,
+                                  resampling=ref['resampling'])
+            if src.nodata is not None and not np.isnan(src.nodata):
+                out[out == src.nodata] = np.nan
+
+
+def load_burst_array(burst_ts_df, creds, event, polarizations=['VV', 'VH'], max_workers=10, as_xarray=False,
+                     geometry=None, geometry_crs='EPSG:4326', res=None):
+    """
+    Load the time series of a burst into a numpy array of shape
+    (time, polarization, band, y, x).
 
+    Images are read directly through /vsis3/ into pre-allocated
+    slots of the array by max_workers threads. Images that could
+    not be read are left as NaN.
 
-def load_single_image(s3_path, fs, time):
-    """Helper function to load a single image with retries."""
-    with fs.open(s3_path, mode='rb') as f:
-        da = xr.open_dataarray(f, engine="rasterio")  # Adjust chunking if needed
-        da = da.expand_dims(time=pd.Index([time], name='time'))
+    Inputs
+    ------
+    burst_ts_df = dataframe with burst time series.
+    creds = S3 access key dictionary 
+    as_xarray = return an xarray.DataArray view of the array
+        (with time, polarization, x and y coordinates) instead of
+        (array, profile) with the grid of the burst.
+    geometry = shapely geometry (in geometry_crs), e.g. the AOI or
+        the active tiles. If provided, only the window of the burst
+        covering the bounds of its intersection with geometry is
+        read, and None is returned if they do not intersect.
+    res = output resolution (in burst CRS units, e.g. 60 or 120). If
+        coarser than the burst, images are read at res from the COG
+        overviews (averaged from full resolution if there are none).
+    """
+    session = AWSSession(aws_access_key_id=creds['accessKeyId'],
+                         aws_secret_access_key=creds['secretAccessKey'],
+                         aws_session_token=creds['sessionToken'])
+    opera_ids = burst_ts_df['OPERA L2-RTC-S1 ID'].tolist()
+
+    # Grid of the burst from the first image
+    with rasterio.Env(session, **GDAL_S3_CONFIG):
+        with rasterio.open(opera_s3_path(opera_ids[0], polarizations[0], event)) as src:
+            ref = {
+                'transform': src.transform,
+                'bounds': src.bounds,
+                'crs': src.crs,
+                'count': src.count,
+                'height': src.height,
+                'width': src.width,
+                'epsg': int(src.tags().get('BOUNDING_BOX_EPSG_CODE', src.crs.to_epsg())),
+                'src_transform': src.transform,
+                'src_shape': (src.height, src.width),
+                'window': Window(0, 0, src.width, src.height),
+                'resampling': Resampling.nearest,
+            }
+
+    if geometry is not None:
+        # Window of the burst covering its intersection with geometry
+        geom = shape(transform_geom(geometry_crs, ref['crs'], mapping(geometry)))
+        clip = geom.intersection(box(*ref['bounds']))
+        if clip.is_empty:
+            return None
+        col_start, row_start = ~ref['src_transform'] * (clip.bounds[0], clip.bounds[3])
+        col_stop, row_stop = ~ref['src_transform'] * (clip.bounds[2], clip.bounds[1])
+        window = Window.from_slices(
+            (max(int(np.floor(row_start)), 0), min(int(np.ceil(row_stop)), ref['height'])),
+            (max(int(np.floor(col_start)), 0), min(int(np.ceil(col_stop)), ref['width']))
+        )
+        if window.width == 0 or window.height == 0:
+            return None
+        ref.update({
+            'window': window,
+            'transform': window_transform(window, ref['src_transform']),
+            'bounds': window_bounds(window, ref['src_transform']),
+            'height': window.height,
+            'width': window.width,
+        })
+
+    if res is not None and res > ref['src_transform'].a:
+        # Window covering a whole number of output pixels of size res
+        factor_x = res / ref['src_transform'].a
+        factor_y = res / -ref['src_transform'].e
+        width = int(ref['window'].width / factor_x)
+        height = int(ref['window'].height / factor_y)
+        if width == 0 or height == 0:
+            return None
+        window = Window(ref['window'].col_off, ref['window'].row_off, width * factor_x, height * factor_y)
+        ref.update({
+            'window': window,
+            'transform': window_transform(window, ref['src_transform']) * Affine.scale(factor_x, factor_y),
+            'bounds': window_bounds(window, ref['src_transform']),
+            'height': height,
+            'width': width,
+            'resampling': Resampling.average,
+        })
+
+    data = np.full((len(opera_ids), len(polarizations), ref['count'], ref['height'], ref['width']),
+                   np.nan, dtype=np.float32)
+
+    # ThreadPoolExecutor for parallel loading
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = {}
+        for t, opera_id in enumerate(opera_ids):
+            for p, polarization in enumerate(polarizations):
+                path = opera_s3_path(opera_id, polarization, event)
+                futures[executor.submit(read_into, path, data[t, p], session, ref)] = path
+
+        for future in as_completed(futures):
+            if future.exception() is not None:
+                print(f"An error occurred reading {futures[future]}: {future.exception()}")
+
+    if not as_xarray:
+        return data, ref
+
+    # xarray view of the array (no copy), with pixel center coordinates
+    transform = ref['transform']
+    da = xr.DataArray(
+        data,
+        dims=('time', 'polarization', 'band', 'y', 'x'),
+        coords={
+            'time': pd.to_datetime(burst_ts_df['AcquisitionDateTime']).to_numpy(),
+            'polarization': polarizations,
+            'band': np.arange(1, ref['count'] + 1),
+            'y': transform.f + (np.arange(ref['height']) + 0.5) * transform.e,
+            'x': transform.c + (np.arange(ref['width']) + 0.5) * transform.a,
+        },
+        attrs={'BOUNDING_BOX_EPSG_CODE': ref['epsg'], 'transform': tuple(transform)[:6],
+               'window_offsets': (ref['window'].col_off, ref['window'].row_off)},
+    )
     return da
 
 
-def load_burst_ts(burst_ts_df, creds, event):
+def load_burst_ts(burst_ts_df, creds, event, geometry=None, geometry_crs='EPSG:4326', res=None):
     """
     Inputs
     ------
     burst_ts_df = dataframe with burst time series.
     creds = S3 access key dictionary 
+    geometry = geometry to clip the burst to (see load_burst_array)
+    res = output resolution (see load_burst_array)
     """
-    fs = s3fs.S3FileSystem(key=creds['accessKeyId'], secret=creds['secretAccessKey'], token=creds['sessionToken'])
-    polarizations = ['VV', 'VH']
-    da_stack = []
-
-    # ThreadPoolExecutor for parallel loading
-    with ThreadPoolExecutor(max_workers=10) as executor:
-        future_to_data = {}
-
-        for t, row in burst_ts_df.iterrows():
-            opera_id = row['OPERA L2-RTC-S1 ID']
-            time = pd.to_datetime(row['AcquisitionDateTime'])
-
-            # Submit tasks for both polarizations for each row
-            for polarization in polarizations:
-                filename = f"{opera_id}_{polarization}.tif"
-                object_key = f"OPERA_L2_RTC-S1/{opera_id}/{filename}"
-                s3_path = f"s3://{event['Bucket']}/{object_key}"
-
-                # Submit the image load task to the executor
-                future = executor.submit(load_single_image, s3_path, fs, time)
-                future_to_data[future] = (t, polarization)
-
-        # Collect and organize the results
-        results_by_time = {}
-
-        for future in as_completed(future_to_data):
-            try:
-                t, polarization = future_to_data[future]
-                da = future.result()
-
-                # Organize results by time index
-                if t not in results_by_time:
-                    results_by_time[t] = []
-                results_by_time[t].append((polarization, da))
-            except Exception as e:
-                print(f"An error occurred: {e}")
-
-        # Assemble the final dataset
-        for t, polarized_results in sorted(results_by_time.items()):
-            # Ensure results are ordered correctly by polarization
-            polarized_results.sort(key=lambda x: polarizations.index(x[0]))
-            da_polarized = xr.concat(
-                [result[1] for result in polarized_results], 
-                dim=pd.Index(polarizations, name='polarization')
-            )
-            da_stack.append(da_polarized)
-
-    ds = xr.concat(da_stack, dim='time')
-    return ds
+    return load_burst_array(burst_ts_df, creds, event, as_xarray=True,
+                            geometry=geometry, geometry_crs=geometry_crs, res=res)
 
 
 # estimate temporal mean
 def xarray_tmean(ds, pol):
     ts = ds.sel(polarization=pol)
-    temporal_avg = ts.mean(dim='time').persist()
+    # attrs (transform and window offsets of the burst) are kept for tmean2tiff
+    temporal_avg = ts.mean(dim='time', keep_attrs=True).persist()
     epsg_code = 'EPSG:' + str(ds.attrs['BOUNDING_BOX_EPSG_CODE'])
     
     return temporal_avg, epsg_code
@@ -160,26 +318,69 @@ def xarray_tmean(ds, pol):
 def tmean2tiff(temporal_avg, file_output, epsg_code):
     from rasterio.transform import from_origin
     # Define the GeoTIFF metadata
-    transform = from_origin(temporal_avg.x.values.min(), temporal_avg.y.values.max(), 
-                            abs(temporal_avg.x.values[1] - temporal_avg.x.values[0]), 
-                            abs(temporal_avg.y.values[1] - temporal_avg.y.values[0]))
+    if 'transform' in temporal_avg.attrs:
+        # Transform of the (possibly clipped) window read by load_burst_array
+        transform = Affine(*temporal_avg.attrs['transform'])
+    else:
+        transform = from_origin(temporal_avg.x.values.min(), temporal_avg.y.values.max(), 
+                                abs(temporal_avg.x.values[1] - temporal_avg.x.values[0]), 
+                                abs(temporal_avg.y.values[1] - temporal_avg.y.values[0]))
     
-    # Save the temporal mean as a GeoTIFF file
-    with rasterio.open(file_output, 'w', driver='GTiff', 
-                       height=temporal_avg.shape[1], width=temporal_avg.shape[2],
-                       count=temporal_avg.shape[0], dtype=temporal_avg.dtype, crs=epsg_code, transform=transform) as dst:
-        dst.write(temporal_avg.values)
+    # Save the temporal mean as a COG (tiled and compressed, with overviews) built in memory.
+    # It is written to a temporary file first, so the skip check of run_rtc_temp_mean never
+    # finds a partial output.
+    profile = {
+        'driver': 'COG',
+        'height': temporal_avg.shape[1],
+        'width': temporal_avg.shape[2],
+        'count': temporal_avg.shape[0],
+        'dtype': 'float32',
+        'crs': epsg_code,
+        'transform': transform,
+        'nodata': np.nan,
+        'compress': 'DEFLATE',
+        'predictor': 3,
+        'blocksize': 512,
+        'overview_resampling': 'average',
+        'bigtiff': 'IF_SAFER',
+    }
+    tmp_output = f"{file_output}.tmp"
+    try:
+        with rasterio.open(tmp_output, 'w', **profile) as dst:
+            dst.write(temporal_avg.values.astype(np.float32))
+        os.replace(tmp_output, file_output)
+    finally:
+        if os.path.exists(tmp_output):
+            os.remove(tmp_output)
 
 
 # main driver
-def run_rtc_temp_mean(burst_id_list, granule_gdf, creds, event, out_dir, start_date, end_date):
+def run_rtc_temp_mean(burst_id_list, granule_gdf, creds, event, out_dir, start_date, end_date, tiles=None, res=None):
+    """
+    tiles = tiles geojson from prep_tiles (optional). If provided, only
+        the part of each burst overlapping the active (mask == 1) tiles
+        is read and averaged, and bursts not overlapping them are skipped.
+    res = output resolution (optional), e.g. 60 or 120 for quick looks.
+        Outputs are named as full resolution outputs, so use a separate
+        out_dir for each resolution.
+    """
     t_all = time.time() # track processing time
+
+    # geometry of the active tiles
+    geometry = geometry_crs = None
+    if tiles is not None:
+        gdf_tiles = gpd.read_file(tiles)
+        geometry = gdf_tiles[gdf_tiles['mask'] == 1].geometry.union_all()
+        geometry_crs = gdf_tiles.crs.to_wkt()
     
     # Check if the directory exists
     if not os.path.exists(out_dir):
         os.makedirs(out_dir)
         print(f"Directory {out_dir} created.")
     
+    # parse the OPERA IDs of all granules once
+    burst_index = get_burst_index(granule_gdf)
+
     # for burst in burst_id_list:
     for burst in tqdm(burst_id_list, desc="Processing bursts", unit="burst"):
         polarization = ['VV', 'VH']
@@ -190,15 +391,18 @@ def run_rtc_temp_mean(burst_id_list, granule_gdf, creds, event, out_dir, start_d
             # print(f"Temporal VV & VH means for burst {burst} exist, skipping to the next")
             continue
             
-        burst_ids = get_burstid_list(burst, granule_gdf)
-        if len(burst_ids) < 2:
+        burst_ts_df = burst_index.get(burst)
+        if burst_ts_df is None or len(burst_ts_df) < 2:
             print(f"Only one burst available for ID {burst}, skippin temporal average")
             continue
             
         # Load xarray and ensure cleanup
+        burst_ds = None
         try:
-            burst_ts_df = get_burst_ts_df(burst_ids)
-            burst_ds = load_burst_ts(burst_ts_df, creds, event)
+            burst_ds = load_burst_ts(burst_ts_df, creds, event, geometry, geometry_crs, res)
+            if burst_ds is None:
+                print(f"Burst {burst} does not overlap with the active tiles, skipping")
+                continue
             
             for pol in polarization:
                 # calculate temp mean
@@ -208,7 +412,8 @@ def run_rtc_temp_mean(burst_id_list, granule_gdf, creds, event, out_dir, start_d
                 tmean2tiff(burst_tmean, out_tif, epsg_code)
         finally:
             # Ensure dataset is closed even in case of error
-            burst_ds.close()
+            if burst_ds is not None:
+                burst_ds.close()
             gc.collect()
 
     # Track processing time 
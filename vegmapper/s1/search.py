@@ -6,6 +6,9 @@ from functools import reduce
 from pathlib import Path
 
 import geopandas as gpd
+import numpy as np
+import pandas as pd
+import shapely
 
 from vegmapper.asf import geo_search
 from vegmapper.pathurl import PathURL
@@ -23,16 +26,13 @@ def group_granules(granules):
     elif isinstance(granules, gpd.GeoDataFrame):
         gdf_granules = granules.copy()
 
-    gb = gdf_granules.groupby(['pathNumber', 'frameNumber'])
-    gdf_frames = gpd.GeoDataFrame(
-        [[p,
-          f,
-          len(gb.get_group((p, f))),
-          ','.join(gb.get_group((p, f)).sceneName.to_list()),
-          reduce(lambda x, y: x.union(y), gb.get_group((p, f)).geometry)]
-        for p, f in gb.groups.keys()],
-        columns=['pathNumber', 'frameNumber', 'num_granules', 'granules', 'geometry']
+    # One aggregation for the granule lists and one dissolve for the frame footprints
+    df_frames = gdf_granules.groupby(['pathNumber', 'frameNumber']).agg(
+        num_granules=('sceneName', 'size'),
+        granules=('sceneName', ','.join),
     )
+    df_frames['geometry'] = gdf_granules[['pathNumber', 'frameNumber', 'geometry']].dissolve(by=['pathNumber', 'frameNumber']).geometry
+    gdf_frames = gpd.GeoDataFrame(df_frames, geometry='geometry', crs=gdf_granules.crs).reset_index()
 
     return gdf_frames
 
@@ -40,38 +40,51 @@ def group_granules(granules):
 def skim_granules(aoifile, gdf_granules, gdf_frames):
     gdf_aoi = gpd.read_file(aoifile).dissolve()
 
-    # Find indices of neighbor frames
+    # Find indices of neighbor frames (frames overlapping more than 95% of a frame),
+    # comparing only the pairs of frames found intersecting by an STRtree
+    geoms = np.asarray(gdf_frames.geometry)
+    tree = shapely.STRtree(geoms)
+    i_idx, j_idx = tree.query(geoms, predicate='intersects')
+    overlap = shapely.area(shapely.intersection(geoms[i_idx], geoms[j_idx])) / shapely.area(geoms[i_idx])
+    close = overlap > 0.95
     neighbors = []
-    for i, row in gdf_frames.iterrows():
-        overlap = gdf_frames.geometry.apply(lambda x: x.intersection(row['geometry']).area/row['geometry'].area)
-        indices = overlap[overlap > 0.95].index.to_list()
+    for i, indices in pd.Series(j_idx[close]).groupby(i_idx[close]):
+        indices = gdf_frames.index[np.sort(indices.to_numpy())].to_list()
         if len(indices) > 1 and indices not in neighbors:
             neighbors.append(indices)
 
     # Merge neighbor frames
+    if neighbors:
+        # Merged frame numbers are strings (e.g. '102-1002')
+        gdf_frames['frameNumber'] = gdf_frames['frameNumber'].astype(object)
     for indices in neighbors:
         frameNumber = reduce(lambda x, y: f'{x}-{y}', gdf_frames.frameNumber[indices])
         num_granules = reduce(lambda x, y: x+y, gdf_frames.num_granules[indices])
         granules = reduce(lambda x, y: f'{x},{y}', gdf_frames.granules[indices])
-        geometry = reduce(lambda x, y: x.union(y), gdf_frames.geometry[indices])
+        geometry = shapely.union_all(gdf_frames.geometry[indices].values)
         gdf_frames.loc[indices, 'frameNumber'] = frameNumber
         gdf_frames.loc[indices, 'num_granules'] = num_granules
         gdf_frames.loc[indices, 'granules'] = granules
         gdf_frames.loc[indices, 'geometry'] = geometry
     gdf_frames = gdf_frames.drop_duplicates().reset_index(drop=True)
 
-    gdf_frames['overlap_with_aoi'] = 0.0
-    # gdf_frames['exclusive_area'] = None
-    for i, row in gdf_frames.iterrows():
-        # Move the current frame i to the front of list
-        idx = [i] + gdf_frames.index.drop(i).to_list()
-
-        # Subtract other frames from the current frame i and get remaining area
-        # intersected with aoi
-        geom = reduce(lambda x, y: x.difference(y), gdf_frames.geometry[idx])
-        area = gdf_aoi.geometry[0].intersection(geom).area
-        gdf_frames.loc[i, 'overlap_with_aoi'] = area
-        # gdf_frames.loc[i, 'exclusive_area'] = geom
+    # Area of each frame that is not covered by other frames and intersects with aoi.
+    # Only the frames intersecting the frame are subtracted from it, and the frames not
+    # intersecting with aoi are skipped.
+    aoi = gdf_aoi.geometry[0]
+    shapely.prepare(aoi)
+    geoms = np.asarray(gdf_frames.geometry)
+    overlap_with_aoi = np.zeros(len(geoms))
+    in_aoi = np.flatnonzero(shapely.intersects(aoi, geoms))
+    tree = shapely.STRtree(geoms)
+    i_idx, j_idx = tree.query(geoms[in_aoi], predicate='intersects')
+    i_idx = in_aoi[i_idx]
+    others = i_idx != j_idx
+    exclusive = geoms.copy()
+    for i, indices in pd.Series(j_idx[others]).groupby(i_idx[others]):
+        exclusive[i] = shapely.difference(geoms[i], shapely.union_all(geoms[indices.to_numpy()]))
+    overlap_with_aoi[in_aoi] = shapely.area(shapely.intersection(aoi, exclusive[in_aoi]))
+    gdf_frames['overlap_with_aoi'] = overlap_with_aoi
 
     granules_to_drop = ','.join(gdf_frames.loc[gdf_frames.overlap_with_aoi == 0, 'granules']).split(',')
     gdf_granules = gdf_granules[~gdf_granules['sceneName'].isin(granules_to_drop)].reset_index(drop=True)
@@ -85,15 +98,49 @@ def skim_granules(aoifile, gdf_granules, gdf_frames):
     return gdf_granules, gdf_frames
 
 
-def skim_opera_granules(aoifile, gdf_granules):
-    gdf_aoi = gpd.read_file(aoifile).dissolve()
-    gdf_granules = gdf_granules.set_crs("EPSG:4326")
-    # Convert gdf_granules to match the CRS of gdf_aoi
-    gdf_granules = gdf_granules.to_crs(gdf_aoi.crs)
-    # Create a single polygon from the AOI
-    aoi_polygon = gdf_aoi.unary_union
-    # Filter granules that intersect with the AOI polygon
-    granules_in_aoi = gdf_granules.loc[gdf_granules.geometry.intersects(aoi_polygon, align=False)]
+# OPERA RTC-S1 file IDs: OPERA_L2_RTC-S1_{burst ID}_{acquisition time}_{processing time}_{sensor}_{spacing}_{version}
+OPERA_ID_REGEX = r'^(?P<burst_id>OPERA_L2_RTC-S1_T\d{3}-\d{6}-IW\d)_(?P<acquisition_time>\d{8}T\d{6}Z)_(?P<processing_time>\d{8}T\d{6}Z)_'
+
+
+def load_aoi(aoi):
+    """
+    AOI geometry (dissolved, in EPSG:4326) from an AOI file, a GeoDataFrame or a shapely geometry.
+    """
+    if isinstance(aoi, (str, Path)):
+        aoi = gpd.read_file(aoi)
+    if isinstance(aoi, gpd.GeoDataFrame):
+        aoi = aoi.to_crs('EPSG:4326') if aoi.crs is not None else aoi
+        aoi = aoi.geometry.union_all()
+    return aoi
+
+
+def skim_opera_granules(aoi, gdf_granules, latest_only=True):
+    """
+    Keep the OPERA RTC granules that intersect with the AOI (file, GeoDataFrame or geometry in EPSG:4326).
+
+    Granules are selected with a single bulk query of the spatial index of gdf_granules against the
+    prepared AOI geometry. A burst_id column is added and, if latest_only is True, only the latest
+    processed granule is kept for each burst and acquisition time.
+    """
+    aoi = load_aoi(aoi)
+    shapely.prepare(aoi)
+    if gdf_granules.crs is None:
+        gdf_granules = gdf_granules.set_crs('EPSG:4326')
+    else:
+        gdf_granules = gdf_granules.to_crs('EPSG:4326')
+
+    # Filter granules that intersect with the AOI
+    indices = np.sort(gdf_granules.sindex.query(aoi, predicate='intersects'))
+    granules_in_aoi = gdf_granules.iloc[indices].copy()
+
+    ids = granules_in_aoi['fileID'].str.extract(OPERA_ID_REGEX)
+    granules_in_aoi['burst_id'] = ids['burst_id']
+    if latest_only:
+        # Granules reprocessed for the same burst and acquisition: keep the latest processed one
+        ids = ids.reset_index(drop=True)
+        latest = ~ids.sort_values(by='processing_time', kind='stable').duplicated(subset=['burst_id', 'acquisition_time'], keep='last')
+        latest = latest.sort_index() | ids['burst_id'].isna()
+        granules_in_aoi = granules_in_aoi[latest.to_numpy()]
 
     return granules_in_aoi
 